@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.shared_store import SHARED_STORE_URL, open_shared_store
+
+FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", "data/telegram_file_ids.json") # Относительно корня
+
+
+class FileIdCache:
+    """Постоянное соответствие (путь, размер, mtime) -> file_id, выданный Telegram при первой загрузке.
+
+    Пока файл не менялся, повторная отправка идет по file_id без загрузки с диска.
+    С общим хранилищем (SHARED_STORE_URL) соответствия живут в нем и видны всем
+    воркерам, а JSON-файл не используется (несколько процессов не пишут в один файл).
+    Общее хранилище читается в его пуле потоков (get — корутина), пишется в фоне.
+    os.stat и запись JSON-файла идут в собственном фоновом потоке, а не в event loop;
+    set и invalidate только ставят задачу в этот поток и сразу возвращаются.
+    """
+
+    def __init__(self, path=FILE_ID_CACHE_PATH, shared_url=SHARED_STORE_URL):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._worker = ThreadPoolExecutor(1, thread_name_prefix="file-id-cache") # Один поток: порядок операций сохраняется
+        self._save_pending = False
+        self.shared = open_shared_store(shared_url)
+        if self.shared is None and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._ids = json.load(f)
+            except Exception as e:
+                print(f"FileIdCache: failed to load {path}: {e}")
+
+    @staticmethod
+    def _key(file_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    async def get(self, file_path):
+        key = await asyncio.get_running_loop().run_in_executor(self._worker, self._key, file_path)
+        if not key:
+            return None
+        file_id = self._ids.get(key)
+        if file_id is None and self.shared is not None:
+            try:
+                file_id = await self.shared.aget("file_id:" + key)
+            except Exception as e:
+                print(f"FileIdCache: shared store lookup failed: {e}")
+            if file_id is not None:
+                with self._lock:
+                    self._ids[key] = file_id
+        return file_id
+
+    def set(self, file_path, file_id):
+        self._submit(self._set, file_path, file_id)
+
+    def invalidate(self, file_path):
+        self._submit(self._invalidate, file_path)
+
+    def _submit(self, fn, *args):
+        try:
+            self._worker.submit(fn, *args)
+        except RuntimeError: # Кэш уже закрыт (остановка бота)
+            pass
+
+    def _set(self, file_path, file_id):
+        key = self._key(file_path)
+        if not key or self._ids.get(key) == file_id:
+            return
+        with self._lock:
+            # Записи для старых версий того же файла больше не нужны
+            prefix = key.rsplit("|", 2)[0] + "|"
+            for stale in [k for k in self._ids if k.startswith(prefix)]:
+                del self._ids[stale]
+            self._ids[key] = file_id
+        if self.shared is not None:
+            self.shared.set_background("file_id:" + key, file_id)
+        self._schedule_save()
+
+    def _invalidate(self, file_path):
+        key = self._key(file_path)
+        with self._lock:
+            removed = self._ids.pop(key, None) if key else None
+        if self.shared is not None and key:
+            self.shared.delete_background("file_id:" + key)
+        if removed:
+            self._schedule_save()
+
+    def _schedule_save(self):
+        # Несколько изменений подряд (медиагруппа) сохраняются одной записью файла
+        if self.shared is not None or self._save_pending:
+            return
+        self._save_pending = True
+        self._submit(self._background_save)
+
+    def _background_save(self):
+        self._save_pending = False
+        try:
+            self.save()
+        except Exception as e:
+            print(f"FileIdCache: failed to save {self.path}: {e}")
+
+    def close(self):
+        """Дожидается фоновых записей (файл и общее хранилище) и закрывает общее хранилище."""
+        self._worker.shutdown(wait=True)
+        if self._save_pending: # Сохранение, запрошенное уже во время остановки
+            self.save()
+        if self.shared is not None:
+            self.shared.close()
+
+    def save(self):
+        if self.shared is not None:
+            return
+        with self._lock:
+            data = dict(self._ids)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from core.shared_store import SHARED_STORE_URL
+
+# Где хранить состояния диалогов (FSM). По умолчанию — там же, где общие кэши:
+# redis://... — RedisStorage aiogram, sqlite:///path — SQLiteStorage ниже, пусто — в памяти процесса
+FSM_STORAGE_URL = os.getenv("FSM_STORAGE_URL", SHARED_STORE_URL)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в файле SQLite.
+
+    Переживает перезапуск бота и общее для нескольких воркеров на одном хосте
+    (WAL). Запросы выполняются в отдельном потоке: пока другой воркер держит
+    блокировку файла, event loop продолжает обрабатывать апдейты.
+    """
+
+    def __init__(self, path, key_builder=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        # Один поток — все запросы к соединению идут по очереди, без отдельной блокировки
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="fsm-sqlite")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT)")
+
+    def _key(self, key: StorageKey):
+        return self.key_builder.build(key)
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _fetch(self, sql, params):
+        return self._conn.execute(sql, params).fetchone()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._run(
+            self._conn.execute,
+            "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (self._key(key), value))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._run(self._fetch, "SELECT state FROM fsm WHERE key = ?", (self._key(key),))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._run(
+            self._conn.execute,
+            "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+            (self._key(key), json.dumps(data, ensure_ascii=False)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._run(self._fetch, "SELECT data FROM fsm WHERE key = ?", (self._key(key),))
+        return json.loads(row[0]) if row and row[0] else {}
+
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=False)
+
+
+def create_fsm_storage(url=FSM_STORAGE_URL):
+    if not url:
+        return MemoryStorage() # Состояния теряются при перезапуске и не видны другим воркерам
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        from aiogram.fsm.storage.redis import RedisStorage # Нужен пакет redis
+        return RedisStorage.from_url(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteStorage(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported FSM storage URL '{url}'. Use redis://... or sqlite:///path.")
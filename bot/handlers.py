@@ -1,16 +1,31 @@
 import os
+from contextlib import aclosing
+
 from aiogram import Router, F, types
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from .keyboards import main_menu_keyboard, template_topics_keyboard
+from .keyboards import main_menu_keyboard, template_topics_keyboard, topic_selected_keyboard
+from .streaming import StreamingReply
+from .template_catalog import TemplateCatalog
+from .template_delivery import send_template_files
 from core.rag_processor import RAGProcessor # Относительный импорт
+from core.metrics import span
+from core.scheduler import InferenceScheduler, SchedulerBusy, UserRateLimited
+from core.single_flight import SingleFlightAborted
 
 router = Router()
-rag_processor = RAGProcessor() # Инициализируем один раз
+# Создается быстро: индекс и модель грузятся в фоне при старте бота (см. main_bot)
+rag_processor = RAGProcessor()
+# Сколько вопрос, пришедший до окончания загрузки, ждет ее, прежде чем ответить "еще загружаюсь"
+RAG_WARMUP_WAIT = float(os.getenv("RAG_WARMUP_WAIT", "20"))
+# Ограничивает число одновременных запросов к LLM и честно делит очередь между пользователями
+rag_scheduler = InferenceScheduler()
 
 TEMPLATES_DIR = "data/knowledge_base/templates/" # Относительно корня
+# Каталог строится при старте (см. main_bot) и обновляется в фоне, поиск не трогает диск
+template_catalog = TemplateCatalog(TEMPLATES_DIR)
 
 # Состояния для запроса шаблонов
 class TemplateRequest(StatesGroup):
@@ -36,12 +51,13 @@ async def cq_back_to_main_menu(callback: types.CallbackQuery, state: FSMContext)
 
 # Обработка выбора темы из главного меню
 @router.callback_query(F.data.startswith("topic_"))
-async def cq_topic_selected(callback: types.CallbackQuery):
+async def cq_topic_selected(callback: types.CallbackQuery, state: FSMContext):
     topic_name = callback.data.split("_")[1].capitalize()
-    # Можно сразу дать какой-то общий ответ по теме или предложить задать вопрос
-    # Для примера, просто подтвердим выбор и предложим задать вопрос
+    # Тема хранится в данных FSM и ограничивает поиск по базе знаний до сброса (возврата в меню)
+    await state.update_data(topic=topic_name)
     await callback.message.answer(
-        f"Выбрана тема: {topic_name}. Задайте свой вопрос по этой теме."
+        f"Выбрана тема: {topic_name}. Задайте свой вопрос по этой теме — искать буду в ее материалах.",
+        reply_markup=topic_selected_keyboard()
     )
     await callback.answer() # Закрыть "часики" на кнопке
 
@@ -73,28 +89,15 @@ async def cq_request_template_start(callback: types.CallbackQuery, state: FSMCon
 async def process_template_keywords(message: types.Message, state: FSMContext):
     # data = await state.get_data()
     # topic = data.get("selected_topic") # если был выбор темы
-    keywords = message.text.lower().split()
-    await state.clear()
+    await state.set_state(None) # Выходим из ввода ключевых слов, но выбранную тему сохраняем
 
-    found_files = []
-    # Упрощенный поиск: ищем в названиях файлов по всем темам (или в конкретной, если был выбор)
-    # search_path = os.path.join(TEMPLATES_DIR, topic) if topic else TEMPLATES_DIR
-    search_path = TEMPLATES_DIR
-
-    for root, _, files in os.walk(search_path):
-        for file_name in files:
-            # Ищем все ключевые слова в имени файла
-            if all(keyword in file_name.lower() for keyword in keywords):
-                found_files.append(os.path.join(root, file_name))
+    # Поиск по каталогу шаблонов: имя файла, папка-тема и описание
+    with span("template_lookup"):
+        found_files = template_catalog.search(message.text)
     
     if found_files:
         await message.answer(f"Нашел следующие шаблоны по вашему запросу ({message.text}):")
-        for file_path in found_files:
-            try:
-                doc = types.FSInputFile(file_path)
-                await message.answer_document(doc)
-            except Exception as e:
-                await message.answer(f"Не удалось отправить файл {os.path.basename(file_path)}: {e}")
+        await send_template_files(message, found_files)
         # Предложить вернуться в меню
         await message.answer("Хотите что-то еще?", reply_markup=main_menu_keyboard())
     else:
@@ -107,7 +110,7 @@ async def process_template_keywords(message: types.Message, state: FSMContext):
 
 # Обработка свободного текстового вопроса
 @router.message(F.text)
-async def handle_text_question(message: types.Message):
+async def handle_text_question(message: types.Message, state: FSMContext):
     user_question = message.text
     
     # Простая проверка на запрос шаблона по ключевым словам
@@ -125,21 +128,13 @@ async def handle_text_question(message: types.Message):
             await message.answer("Пожалуйста, уточните, какой именно шаблон вам нужен (например, 'шаблон вакансии менеджера').", reply_markup=main_menu_keyboard())
             return
 
-        # Процедура поиска файлов, аналогичная той, что в FSM
-        found_files = []
-        for root, _, files in os.walk(TEMPLATES_DIR):
-            for file_name in files:
-                if all(keyword in file_name.lower() for keyword in keywords_for_search):
-                    found_files.append(os.path.join(root, file_name))
+        # Тот же поиск по каталогу, что и в FSM
+        with span("template_lookup"):
+            found_files = template_catalog.search(" ".join(keywords_for_search))
         
         if found_files:
             await message.answer(f"Похоже, вы ищете шаблон. Нашел следующее по запросу '{user_question}':")
-            for file_path in found_files:
-                try:
-                    doc = types.FSInputFile(file_path)
-                    await message.answer_document(doc)
-                except Exception as e:
-                    await message.answer(f"Не удалось отправить файл {os.path.basename(file_path)}: {e}")
+            await send_template_files(message, found_files)
             await message.answer("Если это не то, что вы искали, или у вас есть другой вопрос, пожалуйста, задайте его.", reply_markup=main_menu_keyboard())
             return
         else:
@@ -147,19 +142,85 @@ async def handle_text_question(message: types.Message):
             return
 
 
-    # Если не запрос шаблона, то это вопрос к RAG
-    await message.answer("Получил ваш вопрос, сейчас подумаю... 🤔")
-    
-    # Используем run_in_executor для неблокирующего вызова RAG
-    # так как RAG может быть ресурсоемким
-    loop = asyncio.get_event_loop()
+    # Если не запрос шаблона, то это вопрос к RAG (в пределах выбранной темы, если она есть)
+    topic = (await state.get_data()).get("topic")
+    placeholder = None
+
+    async def notify(text):
+        if placeholder is not None:
+            await placeholder.edit_text(text, reply_markup=main_menu_keyboard())
+        else:
+            await message.answer(text, reply_markup=main_menu_keyboard())
+
+    if not rag_processor.is_ready:
+        # Бот только что запустился: индекс и модель эмбеддингов еще грузятся в фоне
+        placeholder = await message.answer("Я только что перезапустился и загружаю базу знаний, отвечу через несколько секунд... ⏳")
+        try:
+            ready = await rag_processor.wait_ready(RAG_WARMUP_WAIT)
+        except Exception as e:
+            print(f"Error while loading RAG: {e}")
+            ready = False
+        if not ready:
+            await notify("База знаний еще загружается. Пожалуйста, повторите вопрос через минуту.")
+            return
+
+    # Ответ из кэша отдаем сразу, в обход очереди
+    cached = await rag_processor.cached_answer(user_question, topic)
+    if cached is not None:
+        placeholder = placeholder or await message.answer("Получил ваш вопрос, сейчас подумаю... 🤔")
+        await StreamingReply(placeholder, reply_markup=main_menu_keyboard()).finish(cached)
+        return
+
+    # Такой же вопрос уже генерируется (его задали сразу несколько человек) — ждем тот же ответ, минуя очередь
+    in_flight = rag_processor.join_in_flight(user_question, topic)
+    if in_flight is not None:
+        try:
+            placeholder = placeholder or await message.answer("Получил ваш вопрос, сейчас подумаю... 🤔")
+            answer = await in_flight
+        except SingleFlightAborted:
+            answer = None # Тот запрос прервался — задаем вопрос сами, через очередь
+        except Exception as e:
+            if placeholder is None:
+                raise
+            print(f"Error while waiting for an identical question: {e}")
+            answer = "Произошла внутренняя ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
+        finally:
+            in_flight.close() # Возвращаем место ожидающего, если до ожидания не дошли (не отправился placeholder)
+        if answer is not None:
+            await StreamingReply(placeholder, reply_markup=main_menu_keyboard()).finish(answer)
+            return
+
+    try:
+        ticket = rag_scheduler.submit(message.from_user.id)
+    except UserRateLimited:
+        await notify("Вы задаете вопросы слишком часто. Дождитесь ответа на предыдущие и попробуйте снова.")
+        return
+    except SchedulerBusy:
+        await notify("Сейчас очень много вопросов, я не успеваю. Пожалуйста, повторите вопрос через пару минут.")
+        return
+
+    try:
+        placeholder = placeholder or await message.answer("Получил ваш вопрос, сейчас подумаю... 🤔")
+    except BaseException:
+        ticket.release() # Например, flood-лимит Telegram: без release место в планировщике осталось бы занятым навсегда
+        raise
+    reply = StreamingReply(placeholder, reply_markup=main_menu_keyboard())
+
+    async def show_position(position):
+        await placeholder.edit_text(f"Ваш вопрос в очереди, номер {position}. Скоро отвечу ⏳")
+
+    # Ответ генерируется асинхронно и выводится по мере прихода токенов;
+    # одновременных генераций не больше, чем слотов в планировщике
     try:
-        # Это важно, так как rag_processor.get_answer() - синхронная и блокирующая функция
-        # Если она будет асинхронной внутри, то это не нужно.
-        # Но sentence-transformers и faiss по умолчанию синхронные.
-        answer = await loop.run_in_executor(None, rag_processor.get_answer, user_question)
+        await ticket.wait_turn(show_position)
+        # aclosing: если отправка в Telegram упала, генерация и запрос к LLM закрываются сразу, а не при сборке мусора
+        async with aclosing(rag_processor.stream_answer(user_question, topic=topic)) as deltas:
+            async for delta in deltas:
+                await reply.append(delta)
     except Exception as e:
         print(f"Error during RAG processing: {e}")
-        answer = "Произошла внутренняя ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
+        reply.text = "Произошла внутренняя ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
+    finally:
+        ticket.release()
 
-    await message.answer(answer, reply_markup=main_menu_keyboard())
\ No newline at end of file
+    await reply.finish()
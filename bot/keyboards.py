@@ -12,6 +12,11 @@ def main_menu_keyboard():
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     return keyboard
 
+def topic_selected_keyboard():
+    # Сброс выбранной темы — тот же возврат в меню, что и в выборе шаблонов
+    buttons = [[InlineKeyboardButton(text="🔎 Искать по всем темам", callback_data="back_to_main_menu")]]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 def template_topics_keyboard():
     # Предполагаем, что темы для шаблонов те же, что и для текстов
     buttons = [
@@ -1,11 +1,173 @@
+import time
+
+_process_started = time.perf_counter() # До тяжелых импортов — для замера этапов запуска
+
 import asyncio
 import logging
+import multiprocessing
 import os
+import signal
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage # Для FSM
 from dotenv import load_dotenv
 
-from bot.handlers import router as main_router # Убедитесь, что путь правильный
+from bot.handlers import router as main_router, rag_processor, template_catalog # Убедитесь, что путь правильный
+from bot.template_delivery import file_id_cache
+from bot.fsm_storage import create_fsm_storage
+from bot.middlewares import MetricsMiddleware, drain_in_flight
+from core.metrics import METRICS_PORT, Counter, Gauge, record_startup_phase, start_metrics_server, startup_phase
+
+_imports_seconds = time.perf_counter() - _process_started
+
+BOT_MODE = os.getenv("BOT_MODE", "polling") # polling | webhook
+# Telegram шлет обновления на WEBHOOK_BASE_URL + WEBHOOK_PATH (обычно через reverse proxy с TLS),
+# а бот слушает WEBHOOK_HOST:WEBHOOK_PORT
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько процессов слушают один порт (SO_REUSEPORT, соединения между ними распределяет ядро).
+# Каждый процесс держит свою копию индекса и модели; FSM и кэши — в общем хранилище (SHARED_STORE_URL)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# Сколько при остановке ждать начатые ответы, прежде чем закрыться
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "60"))
+
+def register_cache_metrics():
+    # Счетчики кэша ответов и микробатчера читаются при каждом сборе метрик
+    cache = rag_processor.answer_cache
+    Counter("rag_answer_cache_exact_hits_total", "Exact-match answer cache hits", fn=lambda: cache.exact_hits)
+    Counter("rag_answer_cache_semantic_hits_total", "Semantic answer cache hits", fn=lambda: cache.semantic_hits)
+    Counter("rag_answer_cache_misses_total", "Answer cache misses", fn=lambda: cache.misses)
+    Counter("rag_answer_cache_saved_llm_seconds_total", "LLM generation time saved by cache hits",
+            fn=lambda: cache.saved_llm_seconds)
+    Gauge("rag_answer_cache_entries", "Entries in the answer cache", fn=lambda: cache.stats()["size"])
+    # Индекс грузится в фоне, до готовности микробатчера еще нет
+    Counter("rag_embed_batches_total", "Embedding micro-batches processed",
+            fn=lambda: rag_processor.vector_store.batcher.batches if rag_processor.is_ready else 0)
+    Gauge("rag_ready", "1 when the vector store and embedding model are loaded", fn=lambda: rag_processor.is_ready)
+
+async def on_startup():
+    # Индекс и модель грузятся в фоне: меню и шаблоны доступны сразу, вопросы ждут готовности
+    await rag_processor.start()
+    with startup_phase("template_catalog"):
+        await template_catalog.start() # Строим каталог шаблонов до начала приема сообщений
+    record_startup_phase("until_polling", time.perf_counter() - _process_started)
+
+async def on_shutdown():
+    # Прием новых обновлений уже остановлен; дожидаемся начатых ответов, чтобы они дошли до пользователей
+    await drain_in_flight(DRAIN_TIMEOUT)
+
+def create_dispatcher():
+    dp = Dispatcher(storage=create_fsm_storage())
+    dp.include_router(main_router)
+    main_router.message.middleware(MetricsMiddleware())
+    main_router.callback_query.middleware(MetricsMiddleware())
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    # Dispatcher первым регистрирует закрытие FSM-хранилища, а drain должен отработать раньше него
+    dp.shutdown.handlers.insert(0, dp.shutdown.handlers.pop())
+    dp.shutdown.register(template_catalog.stop)
+    dp.shutdown.register(rag_processor.stop) # Перестаем следить за новыми снимками индекса
+    dp.shutdown.register(rag_processor.llm_service.aclose) # Закрываем пул соединений к OpenAI
+    # Сохраняем кэш ответов (если задан ANSWER_CACHE_PATH), дописываем отложенные записи
+    # в общее хранилище (SHARED_STORE_URL) и закрываем его
+    dp.shutdown.register(rag_processor.answer_cache.close)
+    dp.shutdown.register(file_id_cache.close)
+    return dp
+
+async def start_worker_metrics(worker_index=0):
+    if not METRICS_PORT:
+        return None
+    register_cache_metrics()
+    # У каждого воркера свой порт метрик: METRICS_PORT, METRICS_PORT + 1, ...
+    return await start_metrics_server(port=METRICS_PORT + worker_index)
+
+async def run_polling(bot):
+    dp = create_dispatcher()
+    metrics_runner = await start_worker_metrics()
+    # Удаляем вебхук, если он был установлен ранее
+    await bot.delete_webhook(drop_pending_updates=True)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+async def run_webhook_worker(bot, worker_index=0):
+    """Один процесс вебхук-сервера: принимает обновления на общем порту до SIGTERM/SIGINT."""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    dp = create_dispatcher()
+    app = web.Application()
+    # Хуки диспетчера (drain, сохранение кэшей) выполняются раньше закрытия сессии бота в SimpleRequestHandler
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1).start()
+    metrics_runner = await start_worker_metrics(worker_index)
+    logging.info(f"Webhook worker {worker_index} (pid {os.getpid()}) listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    logging.info(f"Webhook worker {worker_index} stopping...")
+    # Сначала закрывается порт (новые обновления уходят другим воркерам или ждут в Telegram),
+    # затем on_shutdown: drain начатых ответов, закрытие хранилищ, сохранение кэшей
+    await runner.cleanup()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+def webhook_worker_process(worker_index):
+    """Точка входа дочернего процесса (multiprocessing spawn)."""
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_webhook_worker_main(worker_index))
+
+async def _webhook_worker_main(worker_index):
+    await run_webhook_worker(Bot(token=os.getenv("TELEGRAM_BOT_TOKEN")), worker_index)
+
+async def run_webhook(bot):
+    if not WEBHOOK_BASE_URL:
+        logging.error("WEBHOOK_BASE_URL is required in webhook mode.")
+        return
+    await bot.set_webhook(WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+    if WEBHOOK_WORKERS <= 1:
+        await run_webhook_worker(bot)
+        return
+
+    # Главный процесс только следит за воркерами: перезапускает упавших и передает им сигнал остановки
+    await bot.session.close()
+    context = multiprocessing.get_context("spawn")
+
+    def spawn(worker_index):
+        process = context.Process(target=webhook_worker_process, args=(worker_index,), name=f"bot-worker-{worker_index}")
+        process.start()
+        return process
+
+    workers = [spawn(i) for i in range(WEBHOOK_WORKERS)]
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+        for i, process in enumerate(workers):
+            if not stop.is_set() and not process.is_alive():
+                logging.error(f"Webhook worker {i} exited with code {process.exitcode}, restarting.")
+                workers[i] = spawn(i)
+
+    logging.info("Stopping webhook workers...")
+    for process in workers:
+        if process.is_alive():
+            process.terminate() # SIGTERM: воркер закрывает порт и дожидается начатых ответов
+    await loop.run_in_executor(None, lambda: [process.join() for process in workers])
 
 async def main():
     load_dotenv() # Загружаем переменные из .env в корне проекта
@@ -16,18 +178,15 @@ async def main():
         return
 
     bot = Bot(token=bot_token)
-    # storage = RedisStorage.from_url(os.getenv("REDIS_URL")) # для production
-    storage = MemoryStorage() # для разработки
-    dp = Dispatcher(storage=storage)
-
-    dp.include_router(main_router)
     
     logging.basicConfig(level=logging.INFO)
-    logging.info("Bot starting...")
+    logging.info(f"Bot starting in {BOT_MODE} mode...")
+    record_startup_phase("imports", _imports_seconds)
 
-    # Удаляем вебхук, если он был установлен ранее
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        await run_webhook(bot)
+    else:
+        await run_polling(bot)
 
 if __name__ == '__main__':
     # Убедитесь, что вы находитесь в корневой папке проекта при запуске
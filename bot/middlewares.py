@@ -0,0 +1,60 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from core.metrics import HANDLER_DURATION, HANDLER_ERRORS, UPDATES_IN_FLIGHT, request_context
+
+# Задачи, которые прямо сейчас выполняют хендлеры, — их дожидается drain_in_flight при остановке
+_in_flight_tasks = set()
+
+
+async def drain_in_flight(timeout):
+    """Ждет завершения начатых хендлеров (например, стриминга ответа), но не дольше timeout секунд."""
+    pending = {task for task in _in_flight_tasks if task is not asyncio.current_task()}
+    if not pending:
+        return
+    print(f"Draining {len(pending)} in-flight update(s)...")
+    done, pending = await asyncio.wait(pending, timeout=timeout)
+    if pending:
+        print(f"Drain timeout: {len(pending)} update(s) still running.")
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время обработки и ошибки по хендлерам, число обновлений в работе и correlation id запроса.
+
+    Регистрируется как inner-middleware на router.message / router.callback_query,
+    поэтому известен конкретный хендлер, который обработает событие.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        handler_name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        update = data.get("event_update")
+        user = data.get("event_from_user")
+
+        task = asyncio.current_task()
+        _in_flight_tasks.add(task)
+        UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            with request_context(
+                handler_name,
+                request_id=f"upd-{update.update_id}" if update else None,
+                user_id=user.id if user else None,
+            ):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=handler_name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, handler=handler_name)
+            UPDATES_IN_FLIGHT.dec()
+            _in_flight_tasks.discard(task)
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from core.metrics import span
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Не чаще одного редактирования сообщения в секунду — иначе Telegram начинает отвечать 429
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+
+def split_message_text(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Делит текст на части не длиннее limit, стараясь резать по переносу строки или пробелу.
+
+    Граница каждой части зависит только от первых limit символов остатка,
+    поэтому по мере дописывания текста уже отправленные части не меняются.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n ") if cut < limit else text[cut:]
+    parts.append(text)
+    return parts
+
+
+class StreamingReply:
+    """Постепенно выводит ответ LLM, редактируя уже отправленное сообщение.
+
+    Редактирования троттлятся (STREAM_EDIT_INTERVAL), при превышении лимита
+    в 4096 символов ответ продолжается в новом сообщении.
+    """
+
+    def __init__(self, message: types.Message, reply_markup=None, min_interval=STREAM_EDIT_INTERVAL):
+        self.messages = [message] # Первое сообщение — заглушка "сейчас подумаю..."
+        self.sent_texts = [message.text or ""]
+        self.reply_markup = reply_markup
+        self.min_interval = min_interval
+        self.text = ""
+        self._last_flush = 0.0
+        self._next_allowed = 0.0
+
+    async def append(self, delta):
+        self.text += delta
+        now = time.monotonic()
+        if now - self._last_flush >= self.min_interval and now >= self._next_allowed:
+            await self.flush()
+
+    async def finish(self, text=None):
+        if text is not None:
+            self.text = text
+        # Финальное состояние должно дойти до пользователя, поэтому ждем окончания flood-лимита
+        while True:
+            delay = self._next_allowed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if await self.flush(final=True):
+                return
+
+    async def flush(self, final=False):
+        """Синхронизирует сообщения с накопленным текстом. Возвращает False, если помешал flood-лимит."""
+        with span("telegram_send"):
+            return await self._flush(final)
+
+    async def _flush(self, final):
+        self._last_flush = time.monotonic()
+        parts = [part for part in split_message_text(self.text) if part.strip()]
+        for i, part in enumerate(parts):
+            is_last = i == len(parts) - 1
+            markup = self.reply_markup if final and is_last else None
+            try:
+                if i < len(self.messages):
+                    if part == self.sent_texts[i] and markup is None:
+                        continue
+                    await self.messages[i].edit_text(part, reply_markup=markup)
+                    self.sent_texts[i] = part
+                else:
+                    new_message = await self.messages[0].answer(part, reply_markup=markup)
+                    self.messages.append(new_message)
+                    self.sent_texts.append(part)
+            except TelegramRetryAfter as e:
+                self._next_allowed = time.monotonic() + e.retry_after
+                return False
+            except TelegramBadRequest as e:
+                # Текст не изменился — для Telegram это ошибка, для нас нет
+                if "message is not modified" not in str(e):
+                    raise
+                self.sent_texts[i] = part
+        return True
@@ -0,0 +1,146 @@
+import asyncio
+import bisect
+import os
+from collections import defaultdict
+
+from core.text_utils import stem_tokens
+
+# Необязательное описание шаблона лежит рядом с файлом: "<имя файла>.desc"
+DESCRIPTION_SUFFIX = ".desc"
+TEMPLATE_CATALOG_REFRESH_INTERVAL = float(os.getenv("TEMPLATE_CATALOG_REFRESH_INTERVAL", "30"))
+
+# Вес совпадения в зависимости от того, где найдено слово
+NAME_WEIGHT = 3.0
+TOPIC_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 1.0
+FUZZY_PENALTY = 0.5 # Совпадение только по префиксу основы весит меньше
+
+
+class _CatalogIndex:
+    """Неизменяемый снимок каталога: инвертированный индекс основа слова -> {файл: вес}."""
+
+    def __init__(self, paths, postings):
+        self.paths = paths
+        self.postings = postings
+        self.vocabulary = sorted(postings)
+
+    def _matching_terms(self, term):
+        if term in self.postings:
+            return [(term, 1.0)]
+        # Нечеткое совпадение: основы, начинающиеся с термина запроса ("менедж" -> "менеджер")
+        matches = []
+        if len(term) >= 4:
+            start = bisect.bisect_left(self.vocabulary, term)
+            for candidate in self.vocabulary[start:]:
+                if not candidate.startswith(term):
+                    break
+                matches.append((candidate, FUZZY_PENALTY))
+        return matches
+
+    def search(self, terms, limit):
+        matched_terms = defaultdict(int)
+        scores = defaultdict(float)
+        for term in terms:
+            matched_docs = {}
+            for candidate, factor in self._matching_terms(term):
+                for doc, weight in self.postings[candidate].items():
+                    matched_docs[doc] = max(matched_docs.get(doc, 0.0), weight * factor)
+            for doc, weight in matched_docs.items():
+                matched_terms[doc] += 1
+                scores[doc] += weight
+        if not matched_terms:
+            return []
+        # Сначала файлы, где нашлись все слова запроса; если таких нет — где нашлось больше всего (но не меньше половины)
+        best = max(matched_terms.values())
+        if best * 2 < len(terms):
+            return []
+        ranked = sorted((doc for doc, count in matched_terms.items() if count == best), key=lambda doc: -scores[doc])
+        return [self.paths[doc] for doc in ranked[:limit]]
+
+
+class TemplateCatalog:
+    """Каталог шаблонов, построенный один раз и обновляемый в фоне при изменении папки.
+
+    Поиск идет по основам слов из имени файла, названия папки-темы и
+    необязательного описания, так что "вакансии" находит "вакансия_менеджер.docx".
+    """
+
+    def __init__(self, templates_dir, refresh_interval=TEMPLATE_CATALOG_REFRESH_INTERVAL):
+        self.templates_dir = templates_dir
+        self.refresh_interval = refresh_interval
+        self._index = _CatalogIndex([], {})
+        self._signature = None
+        self._refresh_task = None
+
+    def _directory_signature(self):
+        # Mtime папки меняется при добавлении, удалении и переименовании файлов в ней
+        signature = []
+        for root, _, _ in os.walk(self.templates_dir):
+            try:
+                signature.append((root, os.stat(root).st_mtime_ns))
+            except OSError:
+                pass
+        return tuple(signature)
+
+    def _build(self):
+        paths = []
+        postings = defaultdict(dict)
+
+        def add_terms(doc, text, weight):
+            for term in stem_tokens(text):
+                postings[term][doc] = max(postings[term].get(doc, 0.0), weight)
+
+        for root, _, files in os.walk(self.templates_dir):
+            topic = os.path.relpath(root, self.templates_dir)
+            for file_name in sorted(files):
+                if file_name.endswith(DESCRIPTION_SUFFIX):
+                    continue
+                doc = len(paths)
+                file_path = os.path.join(root, file_name)
+                paths.append(file_path)
+                add_terms(doc, os.path.splitext(file_name)[0].replace("_", " "), NAME_WEIGHT)
+                if topic != ".":
+                    add_terms(doc, topic, TOPIC_WEIGHT)
+                description_path = file_path + DESCRIPTION_SUFFIX
+                if os.path.exists(description_path):
+                    try:
+                        with open(description_path, 'r', encoding='utf-8') as f:
+                            add_terms(doc, f.read(), DESCRIPTION_WEIGHT)
+                    except Exception as e:
+                        print(f"TemplateCatalog: error reading {description_path}: {e}")
+        return _CatalogIndex(paths, dict(postings))
+
+    def refresh(self, force=False):
+        """Перестраивает каталог, если папка изменилась. Синхронный — вызывать вне event loop."""
+        signature = self._directory_signature()
+        if not force and signature == self._signature:
+            return False
+        self._index = self._build() # Атомарная замена ссылки: поиск всегда видит целый снимок
+        self._signature = signature
+        print(f"TemplateCatalog: indexed {len(self._index.paths)} templates.")
+        return True
+
+    def search(self, query, limit=10):
+        terms = list(dict.fromkeys(stem_tokens(query)))
+        if not terms:
+            return []
+        return self._index.search(terms, limit)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.refresh, True)
+        self._refresh_task = loop.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    async def _refresh_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                print(f"TemplateCatalog: refresh failed: {e}")
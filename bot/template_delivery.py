@@ -0,0 +1,87 @@
+import asyncio
+import os
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from core.metrics import span
+from .file_id_cache import FileIdCache
+
+MEDIA_GROUP_LIMIT = 10 # Telegram принимает в одной медиагруппе от 2 до 10 файлов
+
+file_id_cache = FileIdCache()
+
+
+async def _document(file_path, use_cache):
+    """file_id из кэша (без загрузки) или файл с диска. Второй элемент — взят ли id из кэша."""
+    file_id = await file_id_cache.get(file_path) if use_cache else None
+    if file_id:
+        return file_id, True
+    return types.FSInputFile(file_path), False
+
+
+async def _send_single(message: types.Message, file_path):
+    use_cache = True
+    while True:
+        media, from_cache = await _document(file_path, use_cache)
+        try:
+            sent = await message.answer_document(media)
+            file_id_cache.set(file_path, sent.document.file_id)
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after) # Flood-лимит: ждем, сколько сказал Telegram, и повторяем
+            continue
+        except TelegramBadRequest as e:
+            if from_cache:
+                # file_id устарел или недействителен — забываем его и загружаем файл заново
+                file_id_cache.invalidate(file_path)
+                use_cache = False
+                continue
+            error = e
+        except Exception as e:
+            error = e
+        await message.answer(f"Не удалось отправить файл {os.path.basename(file_path)}: {error}")
+        return
+
+
+async def _send_group(message: types.Message, file_paths):
+    use_cache = True
+    while True:
+        documents = [await _document(file_path, use_cache) for file_path in file_paths]
+        try:
+            sent = await message.answer_media_group(
+                [types.InputMediaDocument(media=media) for media, _ in documents]
+            )
+        except TelegramRetryAfter as e:
+            # Flood-лимит: ждем и повторяем ту же группу. Рассылка по одному файлу
+            # (до 10 запросов вместо одного) только продлила бы лимит
+            await asyncio.sleep(e.retry_after)
+            continue
+        except TelegramBadRequest:
+            if use_cache and any(from_cache for _, from_cache in documents):
+                for file_path, (_, from_cache) in zip(file_paths, documents):
+                    if from_cache:
+                        file_id_cache.invalidate(file_path)
+                use_cache = False
+                continue # Повторяем группу с загрузкой файлов
+            break
+        except Exception:
+            break
+        for file_path, sent_message in zip(file_paths, sent):
+            if sent_message.document:
+                file_id_cache.set(file_path, sent_message.document.file_id)
+        return
+    # Группа не отправилась — шлем по одному, чтобы понять, какой файл мешает
+    for file_path in file_paths:
+        await _send_single(message, file_path)
+
+
+async def send_template_files(message: types.Message, found_files):
+    """Отправляет шаблоны медиагруппами до 10 документов, переиспользуя file_id уже загруженных файлов."""
+    with span("telegram_send"):
+        for start in range(0, len(found_files), MEDIA_GROUP_LIMIT):
+            group = found_files[start:start + MEDIA_GROUP_LIMIT]
+            if len(group) == 1:
+                await _send_single(message, group[0])
+            else:
+                await _send_group(message, group)
@@ -0,0 +1,283 @@
+import base64
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .shared_store import SHARED_STORE_URL, open_shared_store
+from .text_utils import normalize_question
+
+load_dotenv()
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600))) # секунд
+# Порог косинусной близости эмбеддингов вопросов, выше которого считаем вопросы одинаковыми
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92"))
+# Путь для сохранения кэша на диск (пусто — кэш живет только в памяти процесса)
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")
+ANSWER_CACHE_SAVE_EVERY = int(os.getenv("ANSWER_CACHE_SAVE_EVERY", "20"))
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype="float32").reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class AnswerCache:
+    """Кэш готовых ответов RAG.
+
+    Сначала ищется точное совпадение нормализованного текста вопроса, затем —
+    ближайший по эмбеддингу вопрос с косинусной близостью не ниже порога.
+    Записи привязаны к версии индекса, так что после пересборки базы знаний
+    старые ответы перестают находиться. Вытеснение — по TTL и LRU.
+
+    Если задано общее хранилище (SHARED_STORE_URL), ответы дублируются туда,
+    и точные совпадения находятся и в ответах, полученных другими процессами.
+    Из асинхронного кода общее хранилище опрашивается через lookup_exact_async,
+    запись в него идет в фоне — event loop на сетевые обращения не блокируется.
+    """
+
+    def __init__(self, max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL,
+                 similarity_threshold=ANSWER_CACHE_SIMILARITY, persist_path=ANSWER_CACHE_PATH,
+                 shared_url=SHARED_STORE_URL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.persist_path = persist_path or None
+        self._entries = OrderedDict() # (index_version, normalized_question) -> entry
+        self._lock = threading.Lock() # get_answer может вызываться из потоков executor'а
+        self._matrix = None # Кэш матрицы эмбеддингов для семантического поиска
+        self._matrix_keys = []
+        self._matrix_for = None # (index_version, размерность), для которых собрана матрица
+        self._unsaved = 0
+        # Сохранение на диск (pickle всего кэша) — в своем потоке, чтобы put не блокировал event loop
+        self._saver = ThreadPoolExecutor(1, thread_name_prefix="answer-cache-save") if self.persist_path else None
+        self._save_pending = False
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_llm_seconds = 0.0 # Сколько времени генерации сэкономили попадания
+        self.shared = open_shared_store(shared_url)
+        if self.persist_path:
+            self.load()
+
+    def _is_expired(self, entry, now):
+        return self.ttl and now - entry["created"] > self.ttl
+
+    def _hit(self, key, entry):
+        self._entries.move_to_end(key)
+        self.saved_llm_seconds += entry["cost_seconds"]
+        return entry["answer"]
+
+    def lookup_exact(self, question, index_version, shared=True):
+        """Ответ на тот же вопрос. shared=False — только в памяти процесса, без обращения к общему хранилищу."""
+        key = (index_version, normalize_question(question))
+        now = time.time()
+        answer = self._lookup_local(key, now)
+        if answer is None and shared and self.shared is not None:
+            try:
+                entry = self.shared.get(self._shared_key(key))
+            except Exception as e:
+                print(f"AnswerCache: shared store lookup failed: {e}")
+                return None
+            return self._shared_hit(key, entry, now)
+        return answer
+
+    async def lookup_exact_async(self, question, index_version):
+        """lookup_exact для event loop: общее хранилище опрашивается в его пуле потоков."""
+        key = (index_version, normalize_question(question))
+        now = time.time()
+        answer = self._lookup_local(key, now)
+        if answer is None and self.shared is not None:
+            try:
+                entry = await self.shared.aget(self._shared_key(key))
+            except Exception as e:
+                print(f"AnswerCache: shared store lookup failed: {e}")
+                return None
+            return self._shared_hit(key, entry, now)
+        return answer
+
+    def _lookup_local(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, now):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self.exact_hits += 1
+                return self._hit(key, entry)
+        return None
+
+    def _shared_hit(self, key, data, now):
+        if data is None:
+            return None
+        try:
+            entry = self._from_shared(data)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"AnswerCache: malformed shared store entry: {e}")
+            return None
+        if self._is_expired(entry, now):
+            return None
+        with self._lock:
+            self._store(key, entry)
+            self.exact_hits += 1
+            return self._hit(key, entry)
+
+    @staticmethod
+    def _to_shared(entry):
+        # В общее хранилище пишут все процессы бота, поэтому только JSON (не pickle): эмбеддинг — base64 float32
+        return {
+            "answer": entry["answer"],
+            "embedding": base64.b64encode(entry["embedding"].astype("float32").tobytes()).decode("ascii"),
+            "created": entry["created"],
+            "cost_seconds": entry["cost_seconds"],
+        }
+
+    @staticmethod
+    def _from_shared(data):
+        return {
+            "answer": str(data["answer"]),
+            "embedding": np.frombuffer(base64.b64decode(data["embedding"]), dtype="float32"),
+            "created": float(data["created"]),
+            "cost_seconds": float(data["cost_seconds"]),
+        }
+
+    @staticmethod
+    def _shared_key(key):
+        return "answer:" + hashlib.sha1("\n".join(key).encode("utf-8")).hexdigest()
+
+    def lookup_similar(self, embedding, index_version):
+        """Ищет ответ на близкий по смыслу вопрос. Вызывается после промаха lookup_exact."""
+        query = _unit(embedding)
+        now = time.time()
+        with self._lock:
+            if self._matrix is None or self._matrix_for != (index_version, query.shape):
+                self._rebuild_matrix(index_version, query.shape)
+            if not self._matrix_keys:
+                self.misses += 1
+                return None
+            similarities = self._matrix @ query
+            for pos in np.argsort(-similarities):
+                if similarities[pos] < self.similarity_threshold:
+                    break
+                key = self._matrix_keys[pos]
+                entry = self._entries.get(key)
+                if entry is None or self._is_expired(entry, now):
+                    continue
+                self.semantic_hits += 1
+                return self._hit(key, entry)
+            self.misses += 1
+            return None
+
+    def put(self, question, embedding, answer, index_version, cost_seconds=0.0):
+        key = (index_version, normalize_question(question))
+        entry = {
+            "answer": answer,
+            "embedding": _unit(embedding),
+            "created": time.time(),
+            "cost_seconds": cost_seconds,
+        }
+        with self._lock:
+            self._store(key, entry)
+            self._unsaved += 1
+            need_save = self._saver is not None and self._unsaved >= ANSWER_CACHE_SAVE_EVERY and not self._save_pending
+            if need_save:
+                self._save_pending = True
+        if self.shared is not None:
+            self.shared.set_background(self._shared_key(key), self._to_shared(entry), ttl=self.ttl)
+        if need_save:
+            try:
+                self._saver.submit(self._background_save)
+            except RuntimeError: # Кэш уже закрыт (остановка бота)
+                self._save_pending = False
+
+    def _background_save(self):
+        try:
+            self.save()
+        except Exception as e:
+            print(f"AnswerCache: failed to save {self.persist_path}: {e}")
+        finally:
+            with self._lock:
+                self._save_pending = False
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._matrix = None
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        self._matrix = None
+
+    def _rebuild_matrix(self, index_version, shape):
+        # В матрицу попадают только записи текущей версии индекса: после смены
+        # модели эмбеддингов у старых записей может быть другая размерность
+        now = time.time()
+        for key in [key for key, entry in self._entries.items() if self._is_expired(entry, now)]:
+            del self._entries[key]
+        self._matrix_keys = [
+            key for key, entry in self._entries.items()
+            if key[0] == index_version and entry["embedding"].shape == shape
+        ]
+        self._matrix_for = (index_version, shape)
+        if self._matrix_keys:
+            self._matrix = np.stack([self._entries[key]["embedding"] for key in self._matrix_keys])
+        else:
+            self._matrix = np.zeros((0, 0), dtype="float32")
+
+    def stats(self):
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "saved_llm_seconds": round(self.saved_llm_seconds, 3),
+        }
+
+    def close(self):
+        """Дожидается фоновых записей, сохраняет кэш на диск (если задан путь) и закрывает общее хранилище."""
+        if self._saver is not None:
+            self._saver.shutdown(wait=True)
+            self.save()
+        if self.shared is not None:
+            self.shared.close()
+
+    def save(self):
+        if not self.persist_path:
+            return
+        with self._lock:
+            data = list(self._entries.items())
+            self._unsaved = 0
+        os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+        tmp_path = self.persist_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(tmp_path, self.persist_path) # Атомарная замена, чтобы не оставить битый файл
+
+    def load(self):
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            print(f"AnswerCache: failed to load {self.persist_path}: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for key, entry in data[-self.max_size:]:
+                if not self._is_expired(entry, now):
+                    self._entries[key] = entry
+            self._matrix = None
+        print(f"AnswerCache: loaded {len(self._entries)} entries from {self.persist_path}")
@@ -0,0 +1,163 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .metrics import EXECUTOR_QUEUE_WAIT, EMBED_BATCH_SIZE as EMBED_BATCH_SIZE_HISTOGRAM, span
+
+load_dotenv()
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "1")) # Сколько батчей считается одновременно
+
+
+class BatchEmbedder:
+    """Собирает одновременные запросы на эмбеддинг и поиск в микробатчи.
+
+    Вместо отдельного encode([query]) на каждый вопрос все накопившиеся за
+    несколько миллисекунд тексты кодируются одним вызовом encode, а все
+    накопившиеся векторы ищутся одним вызовом index.search. Снаружи API
+    остается поштучным: await embed(text) и await search(embedding, k).
+    """
+
+    def __init__(self, vector_store, max_batch_size=EMBED_BATCH_SIZE, max_wait_ms=EMBED_BATCH_WAIT_MS,
+                 workers=EMBEDDING_WORKERS):
+        self.vector_store = vector_store
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.workers = max(1, workers)
+        # Свои потоки: модель и так параллелит вычисления внутри, а общий пул не занимаем.
+        # Обычно хватает одного; больше имеет смысл при нескольких ядрах/GPU-потоках
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="embedder")
+        self._pending = []
+        self._wakeup = None
+        self._full = None # Выставляется, когда в очереди набрался полный батч
+        self._slots = None
+        self._running = set() # Ссылки на задачи батчей, чтобы их не собрал GC
+        self._worker = None
+        self.batches = 0
+        self.items = 0
+
+    def _submit(self, kind, payload, k=0):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._full = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.workers)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((kind, payload, k, future, time.perf_counter()))
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch_size:
+            self._full.set()
+        return future
+
+    async def embed(self, text):
+        """Эмбеддинг одного текста, форма (1, dim) — как у VectorStore.embed_query."""
+        return await self._submit("embed", text)
+
+    async def search(self, query_embedding, k=5, topic=None):
+        """То же, что VectorStore.search_by_embedding, но в общем батче."""
+        embedding = np.asarray(query_embedding, dtype="float32").reshape(1, -1)
+        return await self._submit("search", (embedding, topic), k)
+
+    async def lexical_search(self, query_text, k=5, topic=None):
+        """VectorStore.lexical_search в потоке батчера (BM25 тоже нагружает CPU)."""
+        return await self._submit("lexical", (query_text, topic), k)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Слот занимаем до сбора батча: пока все потоки заняты, батч продолжает расти
+            await self._slots.acquire()
+            await self._wakeup.wait()
+            # Одиночный запрос при свободном потоке отправляем сразу: копить батч
+            # имеет смысл, только когда запросы идут одновременно. Иначе ждем
+            # либо заполнения батча, либо дедлайна
+            if len(self._pending) > 1:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+            if not self._pending:
+                self._wakeup.clear()
+            if len(self._pending) < self.max_batch_size:
+                self._full.clear()
+            batch = [item for item in batch if not item[3].done()] # Отмененные запросы пропускаем
+            if not batch:
+                self._slots.release()
+                continue
+            task = loop.create_task(self._execute(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, batch):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self._executor, self._process_batch, batch)
+        except Exception as e:
+            for item in batch:
+                if not item[3].done():
+                    item[3].set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        self.batches += 1
+        self.items += len(batch)
+        for item, result in zip(batch, results):
+            if not item[3].done():
+                item[3].set_result(result)
+
+    def _process_batch(self, batch):
+        started = time.perf_counter()
+        for item in batch:
+            EXECUTOR_QUEUE_WAIT.observe(started - item[4], executor="embedder")
+        EMBED_BATCH_SIZE_HISTOGRAM.observe(len(batch))
+        results = [None] * len(batch)
+
+        embed_positions = [i for i, item in enumerate(batch) if item[0] == "embed"]
+        if embed_positions:
+            with span("embed_batch"):
+                embeddings = self.vector_store.embed_texts([batch[i][1] for i in embed_positions])
+            for row, i in enumerate(embed_positions):
+                results[i] = embeddings[row:row + 1]
+
+        # Один вызов index.search на тему: фильтр по id задается на весь вызов
+        searches_by_topic = {}
+        for i, item in enumerate(batch):
+            if item[0] == "search":
+                searches_by_topic.setdefault(item[1][1], []).append(i)
+        for topic, positions in searches_by_topic.items():
+            queries = np.vstack([batch[i][1][0] for i in positions])
+            max_k = max(batch[i][2] for i in positions)
+            with span("search_batch"):
+                per_query = self.vector_store.search_batch_by_embedding(queries, max_k, topic)
+            for row, i in enumerate(positions):
+                results[i] = per_query[row][:batch[i][2]]
+
+        lexical_positions = [i for i, item in enumerate(batch) if item[0] == "lexical"]
+        if lexical_positions:
+            with span("lexical_search"):
+                for i in lexical_positions:
+                    query_text, topic = batch[i][1]
+                    results[i] = self.vector_store.lexical_search(query_text, batch[i][2], topic)
+        return results
+
+    def close(self):
+        """Останавливает сбор батчей и потоки (при выгрузке снимка индекса). Вызывается из любого потока."""
+        worker = self._worker
+        if worker is not None and not worker.done() and not worker.get_loop().is_closed():
+            worker.get_loop().call_soon_threadsafe(worker.cancel)
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+
+from .text_utils import stem_tokens
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60 # Константа reciprocal rank fusion: сглаживает разницу между верхними позициями списков
+
+
+def term_weights(tfs, lengths, df, total, avg_length, k1=BM25_K1, b=BM25_B):
+    """Веса BM25 слова в чанках: tfs — частоты слова, lengths — длины этих чанков, df — в скольких чанках оно есть."""
+    idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+    norm = k1 * (1 - b + b * lengths / max(avg_length, 1e-9))
+    return (idf * tfs * (k1 + 1) / (tfs + norm)).astype("float32")
+
+
+class BM25Index:
+    """Лексический поиск BM25 по чанкам базы знаний.
+
+    Вклад каждого слова в оценку чанка (idf * нормированная частота) считается
+    при сборке (ChunkStoreWriter через term_weights), поэтому поиск — это сложение
+    готовых весов по спискам постингов слов запроса. Слова стеммятся так же, как
+    в каталоге шаблонов. lookup(term) возвращает (ids, weights) или None.
+    """
+
+    def __init__(self, lookup):
+        self.lookup = lookup
+
+    def search(self, query, k=5, allowed_ids=None):
+        """Возвращает [(id чанка, оценка)] по убыванию оценки. allowed_ids — фильтр (np.ndarray id)."""
+        lists = [postings for postings in map(self.lookup, set(stem_tokens(query))) if postings is not None]
+        if not lists or k <= 0:
+            return []
+        ids = np.concatenate([chunk_ids for chunk_ids, _ in lists])
+        weights = np.concatenate([w for _, w in lists])
+        candidate_ids, inverse = np.unique(ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        if allowed_ids is not None:
+            mask = np.isin(candidate_ids, allowed_ids)
+            candidate_ids, scores = candidate_ids[mask], scores[mask]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(candidate_ids[i]), float(scores[i])) for i in top]
+
+
+def reciprocal_rank_fusion(result_lists, k=5, rrf_k=RRF_K):
+    """Сливает несколько ранжированных списков [(id, оценка)] в один такой же список из k лучших.
+
+    Оценка результата — сумма 1 / (rrf_k + ранг) по спискам, где он встретился;
+    сами оценки списков (косинус, BM25) несопоставимы и не используются.
+    """
+    fused = {}
+    for results in result_lists:
+        for rank, (chunk_id, _) in enumerate(results, start=1):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
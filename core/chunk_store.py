@@ -0,0 +1,221 @@
+import itertools
+import json
+import os
+import sqlite3
+import threading
+from collections import Counter
+
+import numpy as np
+
+from .bm25 import term_weights
+from .text_utils import stem_tokens
+
+CHUNK_STORE_FILE = "chunks.sqlite"
+
+
+class ChunkStore:
+    """Тексты и метаданные чанков в SQLite, читаются лениво — только для найденных id.
+
+    Там же лежат списки постингов BM25. При загрузке ничего не читается
+    целиком, поэтому время старта не зависит от размера базы, а страницы
+    файла в page cache общие для всех процессов хоста.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Только чтение: файл пересобирает build_vector_store.py и атомарно подменяет
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock() # Читают поток событий и потоки микробатчера
+        self._topic_ids = {}
+        with self._lock:
+            info = dict(self._conn.execute("SELECT key, value FROM info").fetchall())
+        self.count = int(info.get("count", 0))
+        self.has_postings = info.get("postings") == "1"
+
+    def __len__(self):
+        return self.count
+
+    def get_many(self, ids):
+        """{id: (text, metadata)} для переданных id (отсутствующие пропускаются)."""
+        ids = [int(chunk_id) for chunk_id in ids]
+        if not ids:
+            return {}
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})", ids).fetchall()
+        return {chunk_id: (text, json.loads(metadata)) for chunk_id, text, metadata in rows}
+
+    def ids_for_topic(self, topic):
+        """id чанков темы (без учета регистра) или None, если такой темы нет."""
+        key = topic.casefold()
+        if key not in self._topic_ids:
+            with self._lock:
+                rows = self._conn.execute("SELECT id FROM chunks WHERE topic = ?", (key,)).fetchall()
+            self._topic_ids[key] = np.array([row[0] for row in rows], dtype="int64") if rows else None
+        return self._topic_ids[key]
+
+    def iter_chunks(self, batch_size=1000):
+        """Все чанки (id, text, metadata) по порядку id; читаются пачками, а не целиком."""
+        last_id = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, text, metadata FROM chunks WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            for chunk_id, text, metadata in rows:
+                yield chunk_id, text, json.loads(metadata)
+            last_id = rows[-1][0]
+
+    def get_postings(self, term):
+        """(id чанков, веса BM25) для слова или None."""
+        with self._lock:
+            row = self._conn.execute("SELECT ids, weights FROM postings WHERE term = ?", (term,)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype="int64"), np.frombuffer(row[1], dtype="float32")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class InMemoryChunks:
+    """Тот же интерфейс для старых сборок с metadata.pkl (все чанки в памяти процесса)."""
+
+    has_postings = False
+
+    def __init__(self, ids, texts, metadata):
+        self._chunks = {int(chunk_id): (text, meta) for chunk_id, text, meta in zip(ids, texts, metadata)}
+        self.count = len(self._chunks)
+        ids_by_topic = {}
+        for chunk_id, (_, meta) in self._chunks.items():
+            ids_by_topic.setdefault(meta.get("topic", "").casefold(), []).append(chunk_id)
+        self._topic_ids = {topic: np.array(ids, dtype="int64") for topic, ids in ids_by_topic.items()}
+
+    def __len__(self):
+        return self.count
+
+    def get_many(self, ids):
+        return {int(chunk_id): self._chunks[int(chunk_id)] for chunk_id in ids if int(chunk_id) in self._chunks}
+
+    def ids_for_topic(self, topic):
+        return self._topic_ids.get(topic.casefold())
+
+    def iter_chunks(self):
+        for chunk_id in sorted(self._chunks):
+            text, meta = self._chunks[chunk_id]
+            yield chunk_id, text, meta
+
+    def close(self):
+        pass
+
+
+class ChunkStoreWriter:
+    """Записывает CHUNK_STORE_FILE потоком, не держа чанки в памяти процесса.
+
+    add() пишет чанк в файл пачками и сразу раскладывает его текст на частоты
+    слов во временной таблице; copy_from() переносит неизменные чанки прошлой
+    сборки запросом SQL-to-SQL. finish() считает по частотам постинги BM25 —
+    по одному слову за раз — и атомарно подменяет файл, так что читатели
+    никогда не видят его наполовину записанным. Память сборки не зависит от размера базы.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        for stale in (self.tmp_path, self.tmp_path + "-journal"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        self._conn = sqlite3.connect(self.tmp_path)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("PRAGMA temp_store=FILE") # Частоты слов — на диск, а не в память
+        self._conn.execute(
+            "CREATE TABLE chunks (id INTEGER PRIMARY KEY, topic TEXT, text TEXT NOT NULL, metadata TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE postings (term TEXT PRIMARY KEY, ids BLOB NOT NULL, weights BLOB NOT NULL) WITHOUT ROWID")
+        self._conn.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute(
+            "CREATE TEMP TABLE term_freqs (term TEXT, id INTEGER, tf INTEGER, PRIMARY KEY (term, id)) WITHOUT ROWID")
+        self._conn.execute("CREATE TEMP TABLE lengths (id INTEGER PRIMARY KEY, length INTEGER NOT NULL)")
+        self._chunks = []
+        self._freqs = []
+        self._lengths = []
+
+    def add(self, chunk_id, text, meta):
+        chunk_id = int(chunk_id)
+        self._chunks.append((chunk_id, meta.get("topic", "").casefold(), text, json.dumps(meta, ensure_ascii=False)))
+        self._count_terms(chunk_id, text)
+        if len(self._chunks) >= self.BATCH_SIZE:
+            self._flush()
+
+    def _count_terms(self, chunk_id, text):
+        counts = Counter(stem_tokens(text))
+        self._freqs.extend((term, chunk_id, tf) for term, tf in counts.items())
+        self._lengths.append((chunk_id, sum(counts.values())))
+
+    def _flush(self):
+        self._conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", self._chunks)
+        self._conn.executemany("INSERT INTO term_freqs VALUES (?, ?, ?)", self._freqs)
+        self._conn.executemany("INSERT INTO lengths VALUES (?, ?)", self._lengths)
+        self._chunks, self._freqs, self._lengths = [], [], []
+
+    def copy_from(self, source_path, exclude_ids=()):
+        """Переносит чанки другого файла, кроме exclude_ids. Возвращает число перенесенных."""
+        self._flush()
+        self._conn.execute("CREATE TEMP TABLE excluded (id INTEGER PRIMARY KEY)")
+        self._conn.executemany("INSERT OR IGNORE INTO excluded VALUES (?)", ((int(i),) for i in exclude_ids))
+        self._conn.execute("ATTACH DATABASE ? AS source", (source_path,))
+        copied = self._conn.execute(
+            "INSERT INTO chunks SELECT id, topic, text, metadata FROM source.chunks "
+            "WHERE id NOT IN (SELECT id FROM excluded)").rowcount
+        self._conn.commit()
+        self._conn.execute("DETACH DATABASE source")
+        self._conn.execute("DROP TABLE excluded")
+        # Частоты слов перенесенных чанков (у добавленных через add они уже есть) — пачками по id
+        last_id = -1
+        while True:
+            rows = self._conn.execute(
+                "SELECT id, text FROM chunks WHERE id > ? AND id NOT IN (SELECT id FROM lengths) ORDER BY id LIMIT ?",
+                (last_id, self.BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            for chunk_id, text in rows:
+                self._count_terms(chunk_id, text)
+            self._flush()
+            last_id = rows[-1][0]
+        return copied
+
+    def finish(self):
+        """Досчитывает постинги BM25, публикует файл и возвращает число чанков в нем."""
+        self._flush()
+        count, total_length = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lengths").fetchone()
+        avg_length = total_length / count if count else 0.0
+        rows = self._conn.execute(
+            "SELECT f.term, f.id, f.tf, l.length FROM term_freqs f JOIN lengths l ON l.id = f.id ORDER BY f.term, f.id")
+        batch = []
+        for term, group in itertools.groupby(rows, key=lambda row: row[0]):
+            _, ids, tfs, lengths = zip(*group)
+            weights = term_weights(np.array(tfs, dtype="float32"), np.array(lengths, dtype="float32"),
+                                   len(ids), count, avg_length)
+            batch.append((term, np.array(ids, dtype="int64").tobytes(), weights.tobytes()))
+            if len(batch) >= self.BATCH_SIZE:
+                self._conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", batch)
+                batch = []
+        self._conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", batch)
+        self._conn.execute("CREATE INDEX chunks_topic ON chunks (topic)")
+        self._conn.executemany("INSERT INTO info VALUES (?, ?)", [("count", str(count)), ("postings", "1")])
+        self._conn.commit()
+        self._conn.close()
+        os.replace(self.tmp_path, self.path)
+        return count
+
+    def abort(self):
+        self._conn.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
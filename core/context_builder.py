@@ -0,0 +1,158 @@
+import os
+import re
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Размер контекстного окна известных моделей (в токенах)
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Запас под системный промпт, вопрос и ответ модели
+PROMPT_RESERVE_TOKENS = int(os.getenv("PROMPT_RESERVE_TOKENS", "1500"))
+# Бюджет токенов на КОНТЕКСТ; по умолчанию 3000, но не больше, чем позволяет окно модели
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Чанк, у которого такая доля словесных триграмм уже есть в выбранном фрагменте, считаем дублем
+DUPLICATE_SIMILARITY = float(os.getenv("CONTEXT_DUPLICATE_SIMILARITY", "0.8"))
+MIN_OVERLAP_CHARS = 20 # Более короткое совпадение конца и начала чанков — случайность
+MAX_OVERLAP_CHARS = 600 # С запасом к chunk_overlap=200 сборщика
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class TokenCounter:
+    """Подсчет токенов через tiktoken; без доступа к словарю — приблизительная оценка."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._encoding = None
+        self._loaded = False
+
+    def _get_encoding(self):
+        if not self._loaded:
+            self._loaded = True
+            try:
+                import tiktoken
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model_name)
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # Например, нет сети для загрузки словаря: считаем примерно
+                print(f"TokenCounter: tiktoken unavailable ({e}), using an approximate count.")
+        return self._encoding
+
+    def count(self, text):
+        encoding = self._get_encoding()
+        if encoding is None:
+            return len(text) // 3 + 1 # Для кириллицы в cl100k около 3 символов на токен
+        return len(encoding.encode(text))
+
+    def truncate(self, text, max_tokens):
+        encoding = self._get_encoding()
+        if encoding is None:
+            return text[:max_tokens * 3]
+        return encoding.decode(encoding.encode(text)[:max_tokens])
+
+    def count_messages(self, messages):
+        # ~4 служебных токена на сообщение в формате chat completions
+        return sum(self.count(message["content"]) + 4 for message in messages) + 3
+
+
+def _overlap_length(left, right):
+    """Длина самого длинного суффикса left, совпадающего с префиксом right."""
+    for length in range(min(len(left), len(right), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+
+def _shingles(text):
+    words = _WORD_RE.findall(text.lower())
+    return {tuple(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+
+def _score(chunk, position):
+    # Чем выше score, тем релевантнее; старые результаты без score — по порядку выдачи
+    return chunk.get("score", -position)
+
+
+class ContextBuilder:
+    """Собирает контекст для LLM из найденных чанков.
+
+    Соседние чанки одного источника склеиваются по перекрытию, почти
+    одинаковые отбрасываются, а оставшиеся укладываются по убыванию
+    релевантности в бюджет токенов.
+    """
+
+    def __init__(self, model_name, token_budget=CONTEXT_TOKEN_BUDGET):
+        window = MODEL_CONTEXT_WINDOWS.get(model_name, DEFAULT_CONTEXT_WINDOW)
+        self.token_budget = max(1, min(token_budget, window - PROMPT_RESERVE_TOKENS))
+        self.tokens = TokenCounter(model_name)
+
+    def _merge_neighbours(self, chunks):
+        by_source = {}
+        for position, chunk in enumerate(chunks):
+            item = dict(chunk, score=_score(chunk, position))
+            by_source.setdefault(item["metadata"].get("source"), []).append(item)
+
+        merged = []
+        for items in by_source.values():
+            items.sort(key=lambda item: item["metadata"].get("chunk_index", 0))
+            current = items[0]
+            for item in items[1:]:
+                previous_index = current["metadata"].get("chunk_index_end", current["metadata"].get("chunk_index"))
+                index = item["metadata"].get("chunk_index")
+                if previous_index is None or index is None or index != previous_index + 1:
+                    merged.append(current)
+                    current = item
+                    continue
+                overlap = _overlap_length(current["text"], item["text"])
+                separator = "" if overlap else "\n"
+                current = dict(
+                    current,
+                    text=current["text"] + separator + item["text"][overlap:],
+                    score=max(current["score"], item["score"]),
+                    metadata=dict(current["metadata"], chunk_index_end=index),
+                )
+            merged.append(current)
+        return merged
+
+    def _drop_duplicates(self, chunks):
+        kept = []
+        kept_shingles = []
+        for chunk in chunks: # Уже отсортированы по релевантности — оставляем лучший из дублей
+            shingles = _shingles(chunk["text"])
+            # Доля вложенности, а не Jaccard: кусок, целиком входящий в склеенный фрагмент, тоже дубль
+            if any(len(shingles & other) / min(len(shingles), len(other)) >= DUPLICATE_SIMILARITY for other in kept_shingles):
+                continue
+            kept.append(chunk)
+            kept_shingles.append(shingles)
+        return kept
+
+    def build(self, chunks):
+        """Возвращает список чанков для промпта (по убыванию релевантности), влезающий в бюджет."""
+        if not chunks:
+            return []
+        candidates = sorted(self._merge_neighbours(chunks), key=lambda chunk: -chunk["score"])
+        candidates = self._drop_duplicates(candidates)
+
+        selected = []
+        used_tokens = 0
+        for chunk in candidates:
+            tokens = self.tokens.count(chunk["text"]) + 2 # + разделитель "\n\n"
+            if used_tokens + tokens > self.token_budget:
+                if not selected:
+                    # Даже самый релевантный фрагмент не влезает целиком — обрезаем его
+                    selected.append(dict(chunk, text=self.tokens.truncate(chunk["text"], self.token_budget)))
+                    used_tokens = self.token_budget
+                continue
+            selected.append(chunk)
+            used_tokens += tokens
+        return selected
@@ -0,0 +1,162 @@
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Поддерживаемые типы индекса. Все, кроме flat_l2, работают по скалярному
+# произведению нормализованных векторов (косинусная близость), как и обучалась MiniLM.
+INDEX_TYPES = ("flat_l2", "flat_ip", "ivf_flat", "ivf_pq", "hnsw")
+DEFAULT_INDEX_TYPE = os.getenv("INDEX_TYPE", "flat_ip")
+# Как хранятся векторы в flat/HNSW/IVF-flat индексах: float32 как есть, float16 (вдвое меньше,
+# точность почти та же) или int8 (вчетверо меньше, скалярный квантователь обучается на векторах).
+# На IVF-PQ не влияет — там векторы и так сжаты
+VECTOR_STORAGES = ("float32", "float16", "int8")
+DEFAULT_VECTOR_STORAGE = os.getenv("INDEX_STORAGE", "float32")
+# Отображать индекс в память (mmap) вместо чтения целиком: процессы одного хоста делят
+# страницы в page cache, а загрузка не зависит от размера корпуса. Такой индекс только для чтения
+INDEX_MMAP = os.getenv("INDEX_MMAP", "1") == "1"
+
+DEFAULT_INDEX_PARAMS = {
+    "nlist": 1024,          # IVF: число кластеров
+    "nprobe": 16,           # IVF: сколько кластеров просматривать при поиске
+    "pq_m": 16,             # IVF-PQ: число подквантователей (должно делить размерность)
+    "pq_nbits": 8,          # IVF-PQ: бит на подквантователь
+    "m": 32,                # HNSW: число связей на вершину
+    "ef_construction": 200, # HNSW: ширина поиска при построении
+    "ef_search": 64,        # HNSW: ширина поиска при запросе
+}
+# Параметры, которые меняют только поиск и применяются при загрузке без пересборки
+SEARCH_PARAMS = ("nprobe", "ef_search")
+
+INDEX_CONFIG_FILE = "index_config.json"
+
+
+def make_config(index_type=DEFAULT_INDEX_TYPE, **params):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+    config = {"index_type": index_type, "normalize": index_type != "flat_l2", "storage": DEFAULT_VECTOR_STORAGE}
+    config.update(DEFAULT_INDEX_PARAMS)
+    config.update({key: value for key, value in params.items() if value is not None})
+    if config["storage"] not in VECTOR_STORAGES:
+        raise ValueError(f"Unknown vector storage '{config['storage']}', expected one of {VECTOR_STORAGES}")
+    return config
+
+
+def _scalar_quantizer_type(config):
+    """Тип скалярного квантователя для config["storage"] или None для float32."""
+    storage = config.get("storage", "float32")
+    if storage == "float16":
+        return faiss.ScalarQuantizer.QT_fp16
+    if storage == "int8":
+        return faiss.ScalarQuantizer.QT_8bit
+    return None
+
+
+def build_params(config):
+    """Параметры, от которых зависит содержимое индекса (их смена требует полной пересборки)."""
+    return {key: value for key, value in config.items() if key not in SEARCH_PARAMS}
+
+
+def create_index(config, dimension, train_vectors=None):
+    """Создает пустой индекс с поддержкой add_with_ids; IVF-индексы обучает на train_vectors."""
+    index_type = config["index_type"]
+    qtype = _scalar_quantizer_type(config)
+    if index_type in ("flat_l2", "flat_ip", "hnsw"):
+        if index_type == "hnsw":
+            if qtype is None:
+                index = faiss.IndexHNSWFlat(dimension, config["m"], faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexHNSWSQ(dimension, qtype, config["m"], faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = config["ef_construction"]
+        else:
+            metric = faiss.METRIC_L2 if index_type == "flat_l2" else faiss.METRIC_INNER_PRODUCT
+            if qtype is None:
+                index = faiss.IndexFlat(dimension, metric)
+            else:
+                index = faiss.IndexScalarQuantizer(dimension, qtype, metric)
+        if not index.is_trained:
+            if train_vectors is None or len(train_vectors) == 0:
+                raise ValueError(f"Vector storage '{config['storage']}' needs training vectors")
+            index.train(np.ascontiguousarray(train_vectors, dtype="float32"))
+        return faiss.IndexIDMap(index)
+
+    if train_vectors is None or len(train_vectors) == 0:
+        raise ValueError(f"Index type '{index_type}' needs training vectors")
+    # На маленьком корпусе кластеров не может быть больше, чем точек (FAISS рекомендует ~39 точек на кластер)
+    nlist = max(1, min(config["nlist"], len(train_vectors) // 39))
+    quantizer = faiss.IndexFlatIP(dimension)
+    if index_type == "ivf_flat" and qtype is not None:
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, qtype, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+    else:
+        # Для обучения PQ нужно хотя бы 2^nbits точек
+        nbits = max(1, min(config["pq_nbits"], int(math.log2(len(train_vectors)))))
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, config["pq_m"], nbits, faiss.METRIC_INNER_PRODUCT)
+    index.train(np.ascontiguousarray(train_vectors, dtype="float32"))
+    return index
+
+
+def needs_training(config):
+    return config["index_type"] in ("ivf_flat", "ivf_pq") or config.get("storage") == "int8"
+
+
+def supports_remove(config):
+    return config["index_type"] != "hnsw"
+
+
+def read_index(path, config, mmap=INDEX_MMAP):
+    """Читает индекс для поиска. С mmap векторы не копируются в память процесса; менять такой индекс нельзя."""
+    if not mmap:
+        return faiss.read_index(path)
+    if config["index_type"] in ("ivf_flat", "ivf_pq"):
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY # Инвертированные списки
+    else:
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY # Коды flat/SQ-хранилища (в том числе внутри HNSW)
+    return faiss.read_index(path, flags)
+
+
+def apply_search_params(index, config):
+    params = faiss.ParameterSpace()
+    if config["index_type"] in ("ivf_flat", "ivf_pq"):
+        params.set_index_parameter(index, "nprobe", config["nprobe"])
+    elif config["index_type"] == "hnsw":
+        params.set_index_parameter(index, "efSearch", config["ef_search"])
+
+
+def make_search_params(config, selector=None):
+    """Параметры отдельного поиска (фильтр по id). Заменяют параметры индекса, поэтому nprobe/efSearch задаются заново."""
+    if config["index_type"] in ("ivf_flat", "ivf_pq"):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=config["nprobe"])
+    if config["index_type"] == "hnsw":
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=config["ef_search"])
+    return faiss.SearchParameters(sel=selector)
+
+
+def normalize(vectors):
+    vectors = np.array(vectors, dtype="float32", copy=True).reshape(len(vectors), -1)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def save_config(config, store_dir):
+    path = os.path.join(store_dir, INDEX_CONFIG_FILE)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def load_config(store_dir):
+    """Конфигурация индекса, сохраненная сборщиком. Старые сборки без нее — flat_l2 (float32)."""
+    path = os.path.join(store_dir, INDEX_CONFIG_FILE)
+    if not os.path.exists(path):
+        return make_config("flat_l2", storage="float32")
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    config.setdefault("storage", "float32")
+    return config
@@ -1,27 +1,55 @@
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 
+from .context_builder import TokenCounter
+
 load_dotenv()
 
+# Лимиты общего пула HTTP-соединений к OpenAI для асинхронного клиента
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+
+ERROR_RESPONSE = "Извините, произошла ошибка при попытке сгенерировать ответ. Пожалуйста, попробуйте позже."
+
+SYSTEM_PROMPT = """Ты — дружелюбный и опытный наставник по бизнесу посуточной аренды.
+Твоя задача — помочь ученику, отвечая на его вопросы просто, понятно и структурированно.
+Используй только информацию из предоставленного ниже КОНТЕКСТА.
+Если в КОНТЕКСТЕ нет ответа на вопрос, честно скажи, что не можешь ответить на основе имеющихся материалов, и предложи ученику переформулировать вопрос или выбрать другую тему.
+Не придумывай информацию от себя.
+Отвечай развернуто, объясняй сложные моменты простыми словами. Можешь использовать списки, если это уместно.
+"""
+
 class LLMService:
     def __init__(self):
         self.api_key = os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("OPENAI_API_KEY not found in environment variables.")
-        self.client = OpenAI(api_key=self.api_key)
+        # OPENAI_BASE_URL позволяет направить запросы на локальный OpenAI-совместимый сервер
+        # (например, scripts/fake_openai_server.py)
+        self.base_url = os.getenv("OPENAI_BASE_URL") or None
+        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        self._async_client = None # Создается лениво, уже внутри работающего event loop
         self.model_name = os.getenv("LLM_MODEL_NAME", "gpt-3.5-turbo")
+        self.token_counter = TokenCounter(self.model_name)
 
-    def generate_response(self, user_question, context_chunks):
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                ),
+                timeout=LLM_TIMEOUT,
+            )
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client)
+        return self._async_client
+
+    def build_messages(self, user_question, context_chunks):
         context_str = "\n\n".join([chunk["text"] for chunk in context_chunks])
-        
-        system_prompt = """Ты — дружелюбный и опытный наставник по бизнесу посуточной аренды.
-Твоя задача — помочь ученику, отвечая на его вопросы просто, понятно и структурированно.
-Используй только информацию из предоставленного ниже КОНТЕКСТА.
-Если в КОНТЕКСТЕ нет ответа на вопрос, честно скажи, что не можешь ответить на основе имеющихся материалов, и предложи ученику переформулировать вопрос или выбрать другую тему.
-Не придумывай информацию от себя.
-Отвечай развернуто, объясняй сложные моменты простыми словами. Можешь использовать списки, если это уместно.
-"""
 
         user_prompt_template = f"""КОНТЕКСТ:
 ---
@@ -32,19 +60,55 @@ class LLMService:
 
 ТВОЙ ОТВЕТ НАСТАВНИКА:"""
 
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt_template}
+        ]
+        # Логируем размер промпта, чтобы следить за входными токенами на ответ
+        print(f"LLM: prompt tokens: {self.token_counter.count_messages(messages)} ({len(context_chunks)} context chunks)")
+        return messages
+
+    def generate_response(self, user_question, context_chunks):
         try:
             response = self.client.chat.completions.create(
                 model=self.model_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt_template}
-                ],
+                messages=self.build_messages(user_question, context_chunks),
                 temperature=0.7, # Немного креативности, но не слишком
             )
             return response.choices[0].message.content.strip()
         except Exception as e:
             print(f"Error calling OpenAI API: {e}")
-            return "Извините, произошла ошибка при попытке сгенерировать ответ. Пожалуйста, попробуйте позже."
+            return ERROR_RESPONSE
+
+    async def stream_response(self, user_question, context_chunks):
+        """Асинхронно генерирует ответ, отдавая текст по частям (по мере прихода токенов)."""
+        got_any = False
+        try:
+            stream = await self.async_client.chat.completions.create(
+                model=self.model_name,
+                messages=self.build_messages(user_question, context_chunks),
+                temperature=0.7,
+                stream=True,
+            )
+            # async with закрывает HTTP-ответ и в том случае, когда потребитель бросил генератор
+            # (ошибка отправки в Telegram, отмена): иначе соединение так и занимало бы место в пуле
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        got_any = True
+                        yield delta
+        except Exception as e:
+            print(f"Error calling OpenAI API (stream): {e}")
+            # Если часть ответа уже ушла пользователю, дописываем сообщение об ошибке отдельным абзацем
+            yield ("\n\n" if got_any else "") + ERROR_RESPONSE
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
 
 # Пример использования (для отладки)
 if __name__ == '__main__':
@@ -58,4 +122,4 @@ if __name__ == '__main__':
     question = "Что важно при найме горничной?"
     answer = llm.generate_response(question, mock_context)
     print(f"Question: {question}")
-    print(f"Answer: {answer}")
\ No newline at end of file
+    print(f"Answer: {answer}")
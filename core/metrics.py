@@ -0,0 +1,235 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108")) # 0 — не поднимать HTTP-эндпоинт
+# Писать ли по строке JSON-лога на каждый запрос (с correlation id и временем этапов)
+METRICS_LOG_REQUESTS = os.getenv("METRICS_LOG_REQUESTS", "0") == "1"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+request_logger = logging.getLogger("rag.requests")
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=(), fn=None, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn # Значение, вычисляемое при каждом сборе (например, из stats() кэша)
+        self._values = {}
+        self._lock = threading.Lock() # Метрики пишутся и из потоков executor'ов
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        if self.fn is not None:
+            lines.append(f"{self.name} {float(self.fn())}")
+            return lines
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry=registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][position] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def unregister(self, name):
+        self._metrics.pop(name, None)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = Histogram(
+    "rag_stage_duration_seconds", "Duration of request processing stages", ["stage"])
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "rag_llm_time_to_first_token_seconds", "Time from LLM request to the first streamed token")
+EXECUTOR_QUEUE_WAIT = Histogram(
+    "rag_executor_queue_wait_seconds", "Time a job waited before an executor picked it up", ["executor"])
+EMBED_BATCH_SIZE = Histogram(
+    "rag_embed_batch_size", "Number of items per embedding micro-batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds", "Telegram update handling time", ["handler"])
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Telegram updates whose handler raised", ["handler"])
+UPDATES_IN_FLIGHT = Gauge(
+    "bot_updates_in_flight", "Telegram updates being processed right now")
+STARTUP_PHASE = Gauge(
+    "bot_startup_phase_seconds", "Duration of startup phases", ["phase"])
+INDEX_SNAPSHOT = Gauge(
+    "rag_index_snapshot", "Index snapshot versions: 1 for the one serving requests, 0 for replaced ones", ["version"])
+INDEX_RELOADS = Counter(
+    "rag_index_reloads_total", "Background index snapshot reloads", ["result"])
+
+
+# Контекст текущего запроса: correlation id и время этапов для структурного лога
+_current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def current_request_id():
+    request = _current_request.get()
+    return request["id"] if request else None
+
+
+@contextmanager
+def request_context(kind, request_id=None, **fields):
+    request = {"id": request_id or uuid.uuid4().hex[:12], "kind": kind, "spans": {}, **fields}
+    token = _current_request.set(request)
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield request
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _current_request.reset(token)
+        if METRICS_LOG_REQUESTS:
+            request["status"] = status
+            request["duration"] = round(time.perf_counter() - started, 6)
+            request_logger.info(json.dumps(request, ensure_ascii=False, default=str))
+
+
+def observe_stage(stage, seconds):
+    STAGE_DURATION.observe(seconds, stage=stage)
+    request = _current_request.get()
+    if request is not None:
+        request["spans"][stage] = round(request["spans"].get(stage, 0.0) + seconds, 6)
+
+
+@contextmanager
+def span(stage):
+    """Замеряет длительность этапа: гистограмма rag_stage_duration_seconds + запись в лог запроса."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+@contextmanager
+def startup_phase(phase):
+    """Замеряет этап запуска (импорты, загрузка индекса, прогрев модели) и пишет его в лог."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup_phase(phase, time.perf_counter() - started)
+
+
+def record_startup_phase(phase, seconds):
+    STARTUP_PHASE.set(round(seconds, 6), phase=phase)
+    logging.info(f"Startup phase '{phase}' took {seconds:.2f}s")
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Поднимает HTTP-эндпоинт /metrics в формате Prometheus. Возвращает runner для остановки."""
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return runner
@@ -1,32 +1,331 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import aclosing, contextmanager
+
+from dotenv import load_dotenv
+
 from .vector_store import VectorStore
-from .llm_service import LLMService
+from .llm_service import LLMService, ERROR_RESPONSE
+from .answer_cache import AnswerCache
+from .context_builder import ContextBuilder
+from .metrics import INDEX_RELOADS, INDEX_SNAPSHOT, LLM_TIME_TO_FIRST_TOKEN, observe_stage, span, startup_phase
+from .single_flight import SingleFlight, SingleFlightAborted
+from .snapshots import current_version
+from .text_utils import normalize_question
+
+load_dotenv()
+
+# Как часто проверять, не опубликовал ли сборщик новый снимок индекса (секунды; 0 — не проверять)
+SNAPSHOT_POLL_INTERVAL = float(os.getenv("SNAPSHOT_POLL_INTERVAL", "30"))
 
 class RAGProcessor:
-    def __init__(self):
-        self.vector_store = VectorStore()
-        self.llm_service = LLMService()
+    def __init__(self, vector_store=None, llm_service=None, answer_cache=None):
+        # Индекс и модель эмбеддингов грузятся долго, поэтому не в конструкторе,
+        # а в фоне (start) или при первом обращении (load)
+        self.vector_store = vector_store
+        self.llm_service = llm_service or LLMService()
+        self.answer_cache = answer_cache or AnswerCache()
+        # Склейка перекрывающихся чанков и укладка контекста в бюджет токенов модели
+        self.context_builder = ContextBuilder(self.llm_service.model_name)
+        self._ready = threading.Event() # load() выполняется в потоке executor'а
+        if vector_store is not None:
+            self._ready.set()
+            INDEX_SNAPSHOT.set(1, version=vector_store.index_version)
+        self._loading = None
+        self.load_error = None
+        # Сколько запросов сейчас используют каждый VectorStore: замененный новым снимком
+        # закрывается, только когда его отпустит последний запрос (см. use_store)
+        self._store_lock = threading.Lock()
+        self._store_users = {}
+        self._watcher = None
+        self._failed_snapshot = None # Снимок, который не удалось загрузить, — не пробуем его снова
+        # Одинаковые вопросы, заданные одновременно (например, всей группой после урока),
+        # получают один общий ответ вместо отдельных эмбеддинга, поиска и запроса к LLM
+        self.answer_flights = SingleFlight("answer")
         print("RAGProcessor initialized.")
 
-    def get_answer(self, user_question, k_results=3):
+    @property
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def load(self):
+        """Загружает индекс и модель эмбеддингов и прогревает их пробным запросом."""
+        if self.is_ready:
+            return
+        with startup_phase("vector_store_load"):
+            vector_store = VectorStore()
+        with startup_phase("warmup"):
+            # Первые encode/search/подсчет токенов заметно медленнее последующих
+            vector_store.search("Прогрев модели", k=1)
+            self.context_builder.tokens.count("Прогрев модели")
+        self._swap(vector_store)
+        self._ready.set()
+        print("RAGProcessor: vector store loaded and warmed up.")
+
+    def reload_snapshot(self):
+        """Загружает активный снимок индекса, если он сменился, и подменяет им текущий. True — если подменил.
+
+        Выполняется в потоке executor'а, пока запросы обслуживает прежний снимок.
+        Модель эмбеддингов не перезагружается — она та же.
+        """
+        current = self.vector_store
+        if current is None:
+            return False
+        version = current_version(current.store_dir)
+        if version is None or version in (current.snapshot_version, self._failed_snapshot):
+            return False
+        started = time.perf_counter()
+        try:
+            vector_store = VectorStore(current.store_dir, embedding_model=current.embedding_model)
+            vector_store.search("Прогрев модели", k=1)
+        except Exception:
+            self._failed_snapshot = version
+            raise
+        self._swap(vector_store)
+        print(f"RAGProcessor: switched to index snapshot {version} in {time.perf_counter() - started:.2f}s.")
+        return True
+
+    async def watch_snapshots(self, interval=SNAPSHOT_POLL_INTERVAL):
+        """Фоновая задача: раз в interval секунд проверяет CURRENT и подхватывает новый снимок."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            if not self.is_ready:
+                continue
+            try:
+                if await loop.run_in_executor(None, self.reload_snapshot):
+                    INDEX_RELOADS.inc(result="ok")
+            except Exception as e:
+                INDEX_RELOADS.inc(result="error")
+                print(f"RAGProcessor: failed to load index snapshot: {e}")
+
+    def _swap(self, vector_store):
+        with self._store_lock:
+            previous, self.vector_store = self.vector_store, vector_store
+            release = previous is not None and previous not in self._store_users
+        if previous is not None:
+            INDEX_SNAPSHOT.set(0, version=previous.index_version)
+        INDEX_SNAPSHOT.set(1, version=vector_store.index_version)
+        if release:
+            previous.close()
+
+    @contextmanager
+    def use_store(self):
+        """Текущий VectorStore на время поиска: подмена снимка не закроет его посреди запроса."""
+        with self._store_lock:
+            vector_store = self.vector_store
+            self._store_users[vector_store] = self._store_users.get(vector_store, 0) + 1
+        try:
+            yield vector_store
+        finally:
+            with self._store_lock:
+                users = self._store_users.pop(vector_store) - 1
+                if users:
+                    self._store_users[vector_store] = users
+                release = not users and vector_store is not self.vector_store
+            if release:
+                vector_store.close()
+
+    async def start(self):
+        """Запускает загрузку в фоне и сразу возвращает управление (хук dp.startup)."""
+        if self._watcher is None and SNAPSHOT_POLL_INTERVAL > 0:
+            self._watcher = asyncio.get_running_loop().create_task(self.watch_snapshots())
+        if self.is_ready or self._loading is not None:
+            return
+        self._loading = asyncio.get_running_loop().run_in_executor(None, self.load)
+        self._loading.add_done_callback(self._on_loaded)
+
+    async def stop(self):
+        """Останавливает слежение за снимками (хук dp.shutdown)."""
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    def _on_loaded(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        self.load_error = future.exception()
+        self._loading = None # Следующий вопрос попробует загрузить заново
+        print(f"RAGProcessor: failed to load vector store: {self.load_error}")
+
+    async def wait_ready(self, timeout=None):
+        """Ждет окончания загрузки не дольше timeout секунд. Возвращает is_ready."""
+        if self.is_ready:
+            return True
+        await self.start()
+        loading = self._loading
+        if loading is None:
+            return self.is_ready
+        try:
+            await asyncio.wait_for(asyncio.shield(loading), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.is_ready
+
+    def _cache_version(self, topic, vector_store=None):
+        # Ответ в пределах темы может отличаться от ответа по всей базе — кэшируем раздельно
+        index_version = (vector_store or self.vector_store).index_version
+        return f"{index_version}|{topic.casefold()}" if topic else index_version
+
+    def _cache_answer(self, user_question, query_embedding, answer, started, cache_version):
+        # Ошибки генерации не кэшируем, иначе пользователи будут получать их до истечения TTL
+        if not answer or answer.endswith(ERROR_RESPONSE):
+            return
+        self.answer_cache.put(user_question, query_embedding, answer, cache_version,
+                              cost_seconds=time.monotonic() - started)
+
+    async def cached_answer(self, user_question, topic=None):
+        """Готовый ответ из кэша по точному совпадению вопроса (без эмбеддинга и очереди)."""
+        if not self.is_ready:
+            return None
+        return await self.answer_cache.lookup_exact_async(user_question, self._cache_version(topic))
+
+    def get_answer(self, user_question, k_results=3, topic=None):
+        """topic — тема (папка базы знаний), которой ограничивается поиск; None — вся база."""
         print(f"RAG: Received question: {user_question}")
-        relevant_chunks = self.vector_store.search(user_question, k=k_results)
+        self.load()
+        with self.use_store() as vector_store:
+            cache_version = self._cache_version(topic, vector_store)
+            cached = self.answer_cache.lookup_exact(user_question, cache_version)
+            if cached is not None:
+                print("RAG: Answer cache hit (exact).")
+                return cached
+            with span("query_embed"):
+                query_embedding = vector_store.embed_query(user_question)
+            cached = self.answer_cache.lookup_similar(query_embedding, cache_version)
+            if cached is not None:
+                print("RAG: Answer cache hit (semantic).")
+                return cached
+
+            started = time.monotonic()
+            candidates = vector_store.candidate_count(k_results)
+            with span("index_search"):
+                vector_results = vector_store.search_by_embedding(query_embedding, candidates, topic)
+            with span("lexical_search"):
+                lexical_results = vector_store.lexical_search(user_question, candidates, topic)
+            relevant_chunks = vector_store.fuse(vector_results, lexical_results, k_results)
         
         if not relevant_chunks:
             print("RAG: No relevant chunks found.")
             # Можно вернуть стандартный ответ или дать LLM шанс ответить без контекста (с осторожностью)
             # return "К сожалению, я не нашел релевантной информации по вашему вопросу в базе знаний."
             # Дадим LLM шанс, но он должен сам сказать, что не нашел
-            return self.llm_service.generate_response(user_question, [])
+            with span("llm_request"):
+                llm_response = self.llm_service.generate_response(user_question, [])
+            self._cache_answer(user_question, query_embedding, llm_response, started, cache_version)
+            return llm_response
 
 
         print(f"RAG: Found {len(relevant_chunks)} relevant chunks.")
         # for i, chunk in enumerate(relevant_chunks):
         #     print(f"  Chunk {i+1} source: {chunk['metadata']['source']}")
 
-        llm_response = self.llm_service.generate_response(user_question, relevant_chunks)
+        with span("context_build"):
+            context_chunks = self.context_builder.build(relevant_chunks)
+        with span("llm_request"):
+            llm_response = self.llm_service.generate_response(user_question, context_chunks)
         print(f"RAG: LLM response generated.")
+        self._cache_answer(user_question, query_embedding, llm_response, started, cache_version)
         return llm_response
 
+    @staticmethod
+    def coalesce_key(user_question, topic=None):
+        return normalize_question(user_question), topic.casefold() if topic else ""
+
+    def join_in_flight(self, user_question, topic=None):
+        """Awaitable ответа на такой же вопрос, который уже генерируется, или None."""
+        return self.answer_flights.join(self.coalesce_key(user_question, topic))
+
+    async def stream_answer(self, user_question, k_results=3, topic=None):
+        """Асинхронная версия get_answer: отдает ответ по частям по мере генерации.
+
+        Если такой же вопрос уже генерируется, ждет тот ответ и отдает его целиком.
+        """
+        print(f"RAG: Received question (stream): {user_question}")
+        await self.wait_ready()
+        key = self.coalesce_key(user_question, topic)
+        waiting = self.answer_flights.join(key)
+        if waiting is not None:
+            try:
+                answer = await waiting
+            except SingleFlightAborted:
+                pass # Тот запрос прервался — генерируем сами
+            else:
+                print("RAG: Answer shared with an identical in-flight question.")
+                yield answer
+                return
+
+        with self.answer_flights.lead(key) as flight:
+            parts = []
+            async with aclosing(self._stream_answer(user_question, k_results, topic)) as deltas:
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+            flight.resolve("".join(parts).strip())
+
+    async def _stream_answer(self, user_question, k_results, topic):
+        # Снимок индекса держим только на время поиска: генерация ответа ему уже не нужна
+        with self.use_store() as vector_store:
+            cache_version = self._cache_version(topic, vector_store)
+            # Общее хранилище уже опрошено в cached_answer до очереди; здесь — только ответы,
+            # которые этот процесс получил, пока вопрос ждал очереди
+            cached = self.answer_cache.lookup_exact(user_question, cache_version, shared=False)
+            if cached is not None:
+                print("RAG: Answer cache hit (exact).")
+                yield cached
+                return
+
+            # Эмбеддинг и поиск по индексу идут через микробатчер (одновременные вопросы
+            # кодируются одним вызовом модели в отдельном потоке).
+            # LLM-запрос идет напрямую через асинхронный клиент и поток не занимает.
+            batcher = vector_store.batcher
+            with span("query_embed"): # Включая ожидание в очереди микробатчера
+                query_embedding = await batcher.embed(user_question)
+            cached = self.answer_cache.lookup_similar(query_embedding, cache_version)
+            if cached is not None:
+                print("RAG: Answer cache hit (semantic).")
+                yield cached
+                return
+
+            started = time.monotonic()
+            # Векторный и лексический поиск уходят в один микробатч и сливаются через RRF
+            candidates = vector_store.candidate_count(k_results)
+            with span("index_search"):
+                vector_results, lexical_results = await asyncio.gather(
+                    batcher.search(query_embedding, candidates, topic),
+                    batcher.lexical_search(user_question, candidates, topic),
+                )
+            relevant_chunks = vector_store.fuse(vector_results, lexical_results, k_results)
+        print(f"RAG: Found {len(relevant_chunks)} relevant chunks.")
+
+        with span("context_build"):
+            context_chunks = self.context_builder.build(relevant_chunks)
+        parts = []
+        # Время LLM считаем только пока ждем токены, без времени, которое потребитель тратит на отправку в Telegram
+        stream = self.llm_service.stream_response(user_question, context_chunks)
+        llm_started = time.perf_counter()
+        llm_seconds = 0.0
+        try:
+            while True:
+                waited_from = time.perf_counter()
+                try:
+                    delta = await stream.__anext__()
+                except StopAsyncIteration:
+                    llm_seconds += time.perf_counter() - waited_from
+                    break
+                llm_seconds += time.perf_counter() - waited_from
+                if not parts:
+                    LLM_TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - llm_started)
+                parts.append(delta)
+                yield delta
+        finally:
+            await stream.aclose() # Сразу отпускаем соединение к OpenAI, если ответ бросили на середине
+        observe_stage("llm_request", llm_seconds)
+        self._cache_answer(user_question, query_embedding, "".join(parts).strip(), started, cache_version)
+        print("RAG: LLM response streamed.")
+
 # Пример использования (для отладки)
 if __name__ == '__main__':
     # Запускать из корня проекта: python core/rag_processor.py
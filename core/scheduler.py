@@ -0,0 +1,175 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+
+from dotenv import load_dotenv
+
+from .metrics import Counter, Gauge, Histogram
+
+load_dotenv()
+
+RAG_MAX_CONCURRENCY = int(os.getenv("RAG_MAX_CONCURRENCY", "8")) # Одновременных запросов к LLM
+RAG_MAX_QUEUE = int(os.getenv("RAG_MAX_QUEUE", "100")) # Сверх этого — сразу отвечаем "занят"
+RAG_USER_MAX_IN_FLIGHT = int(os.getenv("RAG_USER_MAX_IN_FLIGHT", "2")) # В очереди и в работе на одного пользователя
+RAG_USER_RATE_LIMIT = int(os.getenv("RAG_USER_RATE_LIMIT", "10")) # Вопросов на пользователя за окно
+RAG_USER_RATE_WINDOW = float(os.getenv("RAG_USER_RATE_WINDOW", "60"))
+POSITION_UPDATE_INTERVAL = float(os.getenv("RAG_POSITION_UPDATE_INTERVAL", "3"))
+
+QUEUE_WAIT = Histogram(
+    "rag_scheduler_wait_seconds", "Time a question waited in the scheduler queue",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+REJECTED = Counter(
+    "rag_scheduler_rejected_total", "Questions rejected by admission control", ["reason"])
+
+
+class SchedulerBusy(Exception):
+    """Очередь заполнена — вопрос не принят."""
+
+
+class UserRateLimited(Exception):
+    """Пользователь превысил лимит вопросов в работе или за окно времени."""
+
+
+class _Ticket:
+    def __init__(self, scheduler, user_id):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.state = "queued" # queued -> running -> done
+
+    def position(self):
+        """Позиция в очереди (1 — следующий), 0 — уже выполняется."""
+        return self.scheduler._position(self)
+
+    async def wait_turn(self, on_position=None, update_interval=POSITION_UPDATE_INTERVAL):
+        """Ждет свободный слот; пока ждем, сообщает позицию через on_position(position)."""
+        last_position = None
+        while not self.future.done():
+            position = self.position()
+            if on_position is not None and position != last_position:
+                last_position = position
+                try:
+                    await on_position(position)
+                except Exception as e:
+                    print(f"Scheduler: failed to report queue position: {e}")
+            try:
+                await asyncio.wait_for(asyncio.shield(self.future), update_interval)
+            except asyncio.TimeoutError:
+                pass
+        await self.future
+
+    def release(self):
+        """Освобождает слот (или убирает вопрос из очереди). Повторный вызов безопасен."""
+        self.scheduler._release(self)
+
+
+class InferenceScheduler:
+    """Ограниченная очередь RAG-запросов со справедливым обслуживанием пользователей.
+
+    Одновременно выполняется не больше max_concurrent вопросов, остальные ждут
+    в очереди. Очередь разбита по пользователям и обслуживается по кругу:
+    десять вопросов одного пользователя не задерживают вопрос другого.
+    Все методы вызываются из одного event loop, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, max_concurrent=RAG_MAX_CONCURRENCY, max_queue=RAG_MAX_QUEUE,
+                 user_max_in_flight=RAG_USER_MAX_IN_FLIGHT, user_rate_limit=RAG_USER_RATE_LIMIT,
+                 user_rate_window=RAG_USER_RATE_WINDOW):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.user_max_in_flight = user_max_in_flight
+        self.user_rate_limit = user_rate_limit
+        self.user_rate_window = user_rate_window
+        self._queues = OrderedDict() # user_id -> deque[_Ticket], порядок — очередь обхода по кругу
+        self._queued = 0
+        self._running = 0
+        self._user_active = defaultdict(int) # В очереди + в работе
+        self._user_history = defaultdict(deque) # Время принятых вопросов для лимита частоты
+        Gauge("rag_scheduler_queue_depth", "Questions waiting for an LLM slot", fn=lambda: self._queued)
+        Gauge("rag_scheduler_running", "Questions being answered right now", fn=lambda: self._running)
+
+    def submit(self, user_id):
+        """Ставит вопрос в очередь и возвращает билет. При перегрузке бросает исключение сразу."""
+        now = time.monotonic()
+        history = self._user_history[user_id]
+        while history and now - history[0] > self.user_rate_window:
+            history.popleft()
+        if self.user_rate_limit and len(history) >= self.user_rate_limit:
+            REJECTED.inc(reason="user_rate")
+            raise UserRateLimited("too many questions in the rate window")
+        if self.user_max_in_flight and self._user_active.get(user_id, 0) >= self.user_max_in_flight:
+            REJECTED.inc(reason="user_in_flight")
+            raise UserRateLimited("too many questions in flight")
+        if self._running >= self.max_concurrent and self._queued >= self.max_queue:
+            REJECTED.inc(reason="queue_full")
+            raise SchedulerBusy("scheduler queue is full")
+
+        history.append(now)
+        if len(self._user_history) > 10000:
+            self._forget_idle_users(now)
+        self._user_active[user_id] += 1
+        ticket = _Ticket(self, user_id)
+        self._queues.setdefault(user_id, deque()).append(ticket)
+        self._queued += 1
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        while self._running < self.max_concurrent and self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            # Пользователь с оставшимися вопросами уходит в конец круга
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            self._queued -= 1
+            self._running += 1
+            ticket.state = "running"
+            QUEUE_WAIT.observe(time.monotonic() - ticket.enqueued_at)
+            if not ticket.future.done():
+                ticket.future.set_result(None)
+
+    def _release(self, ticket):
+        if ticket.state == "queued":
+            queue = self._queues.get(ticket.user_id)
+            if queue is not None:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.user_id]
+            self._queued -= 1
+            ticket.future.cancel()
+        elif ticket.state == "running":
+            self._running -= 1
+        else:
+            return
+        ticket.state = "done"
+        self._user_active[ticket.user_id] -= 1
+        if self._user_active[ticket.user_id] <= 0:
+            del self._user_active[ticket.user_id]
+        self._dispatch()
+
+    def _position(self, ticket):
+        if ticket.state != "queued":
+            return 0
+        # Повторяем порядок _dispatch: по одному вопросу от каждого пользователя за круг
+        queues = list(self._queues.values())
+        position = 0
+        for round_index in range(max(len(queue) for queue in queues)):
+            for queue in queues:
+                if round_index < len(queue):
+                    position += 1
+                    if queue[round_index] is ticket:
+                        return position
+        return 0
+
+    def _forget_idle_users(self, now):
+        for user_id in list(self._user_history):
+            history = self._user_history[user_id]
+            if not history or now - history[-1] > self.user_rate_window:
+                del self._user_history[user_id]
+
+    def stats(self):
+        return {"queued": self._queued, "running": self._running, "users_waiting": len(self._queues)}
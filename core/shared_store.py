@@ -0,0 +1,143 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Общее для всех процессов бота хранилище "ключ-значение" (кэш ответов, file_id шаблонов):
+#   redis://host:6379/0      — Redis (нужен пакет redis), для нескольких хостов
+#   sqlite:///data/shared.db — файл SQLite, для нескольких воркеров на одном хосте и для тестов
+#   пусто                    — общего хранилища нет, у каждого процесса свои кэши
+SHARED_STORE_URL = os.getenv("SHARED_STORE_URL", "")
+SHARED_STORE_PREFIX = os.getenv("SHARED_STORE_PREFIX", "rentbot:")
+# Потоки для обращений к хранилищу из асинхронного кода (Redis и SQLite — блокирующие клиенты)
+SHARED_STORE_THREADS = int(os.getenv("SHARED_STORE_THREADS", "4"))
+
+
+class SharedStore:
+    """Общая часть хранилищ: блокирующие get/set/delete и их версии, не занимающие event loop.
+
+    aget/aset/adelete выполняются в собственном пуле потоков хранилища, поэтому
+    медленный Redis или заблокированный файл SQLite не останавливают обработку
+    апдейтов. set_background/delete_background — запись "в фоне" без ожидания,
+    их можно вызывать и из потоков, и из event loop; ошибки только печатаются.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(SHARED_STORE_THREADS, thread_name_prefix="shared-store")
+
+    async def aget(self, key):
+        return await asyncio.wrap_future(self._executor.submit(self.get, key))
+
+    async def aset(self, key, value, ttl=None):
+        await asyncio.wrap_future(self._executor.submit(self.set, key, value, ttl))
+
+    async def adelete(self, key):
+        await asyncio.wrap_future(self._executor.submit(self.delete, key))
+
+    def set_background(self, key, value, ttl=None):
+        self._submit_background(self.set, key, value, ttl)
+
+    def delete_background(self, key):
+        self._submit_background(self.delete, key)
+
+    def _submit_background(self, fn, *args):
+        try:
+            self._executor.submit(fn, *args).add_done_callback(self._report_failure)
+        except RuntimeError as e: # Хранилище уже закрыто (остановка бота)
+            print(f"{type(self).__name__}: background write skipped: {e}")
+
+    def _report_failure(self, future):
+        error = future.exception()
+        if error is not None:
+            print(f"{type(self).__name__}: background write failed: {error}")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True) # Дожидаемся фоновых записей
+
+
+class RedisStore(SharedStore):
+    """Хранилище в Redis. Значения сериализуются в JSON, TTL — средствами Redis."""
+
+    def __init__(self, url, prefix=SHARED_STORE_PREFIX):
+        import redis # Необязательная зависимость, нужна только с redis:// URL
+
+        super().__init__()
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url) # Подключение ленивое, пул потокобезопасен
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def close(self):
+        self.shutdown()
+        self._redis.close()
+
+
+class SQLiteStore(SharedStore):
+    """Хранилище в файле SQLite: общее для процессов одного хоста (WAL, ожидание блокировок)."""
+
+    PRUNE_EVERY = 1000 # Раз в столько записей удаляем истекшие ключи
+
+    def __init__(self, path, prefix=SHARED_STORE_PREFIX):
+        super().__init__()
+        self.prefix = prefix
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Соединение общее для потоков процесса, поэтому доступ под блокировкой
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._writes = 0
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM kv WHERE key = ?", (self.prefix + key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                               (self.prefix + key, json.dumps(value, ensure_ascii=False), expires))
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._conn.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE key = ?", (self.prefix + key,))
+
+    def close(self):
+        self.shutdown()
+        with self._lock:
+            self._conn.close()
+
+
+def open_shared_store(url=SHARED_STORE_URL):
+    """Создает хранилище по URL (см. SHARED_STORE_URL). Пустой URL — None."""
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported shared store URL '{url}'. Use redis://... or sqlite:///path.")
@@ -0,0 +1,132 @@
+import asyncio
+import os
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from .metrics import Counter
+
+load_dotenv()
+
+# Сколько запросов может ждать одно и то же вычисление; остальные считают сами
+COALESCE_MAX_WAITERS = int(os.getenv("COALESCE_MAX_WAITERS", "200"))
+# Сколько ожидающий готов ждать чужой результат (секунды), прежде чем сдаться
+COALESCE_TIMEOUT = float(os.getenv("COALESCE_TIMEOUT", "120"))
+
+# leader — вычисление запущено, coalesced — запрос получил чужой результат,
+# overflow — ожидающих слишком много и запрос посчитал сам, timeout — не дождался
+SINGLE_FLIGHT_CALLS = Counter(
+    "rag_single_flight_total", "Calls through in-flight request coalescing by outcome", ["kind", "outcome"])
+
+
+class SingleFlightTimeout(asyncio.TimeoutError):
+    """Результат одинакового запроса не пришел за COALESCE_TIMEOUT."""
+
+
+class SingleFlightAborted(Exception):
+    """Запрос, результат которого ждали, прервался, не дав результата (например, пользователь ушел)."""
+
+
+class _Flight:
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        # Ошибку забираем сразу, иначе без ожидающих asyncio пишет "exception was never retrieved"
+        self.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.waiters = 0
+
+    def resolve(self, result):
+        if not self.future.done():
+            self.future.set_result(result)
+
+
+class _Waiter:
+    """Занятое место среди ожидающих flight. await — дождаться результата, close() — отказаться от ожидания."""
+
+    def __init__(self, group, flight):
+        self.group = group
+        self.flight = flight
+        self.held = True
+        flight.waiters += 1
+
+    def __await__(self):
+        return self.group._wait(self).__await__()
+
+    def close(self):
+        if self.held:
+            self.held = False
+            self.flight.waiters -= 1
+
+
+class SingleFlight:
+    """Схлопывает одновременные одинаковые вычисления (single flight).
+
+    Пока вычисление с ключом key идет, такие же запросы не запускают свое,
+    а ждут его результат. Результат и ошибка достаются только тем, кто ждал
+    в этот момент, — после завершения ключ забывается, ничего не кэшируется.
+    Работает в пределах одного event loop.
+    """
+
+    def __init__(self, kind, max_waiters=COALESCE_MAX_WAITERS, timeout=COALESCE_TIMEOUT):
+        self.kind = kind
+        self.max_waiters = max_waiters
+        self.timeout = timeout
+        self._flights = {}
+        self.coalesced = 0
+
+    def join(self, key):
+        """Место среди ожидающих идущего вычисления key или None, если его нет (или ждущих уже слишком много).
+
+        Место занимается сразу, поэтому лимит max_waiters соблюдается, даже если
+        между join и await вызывающий успевает что-то сделать (например, отправить
+        сообщение). Результат тоже не потеряется, если вычисление закончится раньше await.
+        Если ждать передумали, место нужно вернуть через close().
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            return None
+        if flight.waiters >= self.max_waiters:
+            SINGLE_FLIGHT_CALLS.inc(kind=self.kind, outcome="overflow")
+            return None
+        return _Waiter(self, flight)
+
+    async def _wait(self, waiter):
+        if not waiter.held:
+            raise RuntimeError(f"{self.kind}: waiter is already closed")
+        self.coalesced += 1
+        SINGLE_FLIGHT_CALLS.inc(kind=self.kind, outcome="coalesced")
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.flight.future), self.timeout)
+        except asyncio.TimeoutError:
+            SINGLE_FLIGHT_CALLS.inc(kind=self.kind, outcome="timeout")
+            raise SingleFlightTimeout(f"{self.kind}: no result after {self.timeout:.0f}s") from None
+        except asyncio.CancelledError:
+            if waiter.flight.future.cancelled():
+                raise SingleFlightAborted(self.kind) from None
+            raise
+        finally:
+            waiter.close()
+
+    @contextmanager
+    def lead(self, key):
+        """Регистрирует вычисление key; результат передается ожидающим через flight.resolve(result).
+
+        Исключение внутри блока достается и ожидающим; выход без результата
+        (отмена, закрытый генератор) — SingleFlightAborted. Если такое же
+        вычисление уже идет, блок просто выполняется, ни с кем не делясь.
+        """
+        flight = _Flight()
+        registered = key not in self._flights
+        if registered:
+            self._flights[key] = flight
+            SINGLE_FLIGHT_CALLS.inc(kind=self.kind, outcome="leader")
+        try:
+            yield flight
+        except Exception as e:
+            if not flight.future.done():
+                flight.future.set_exception(e)
+            raise
+        finally:
+            if registered and self._flights.get(key) is flight:
+                del self._flights[key]
+            if not flight.future.done():
+                flight.future.cancel()
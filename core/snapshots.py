@@ -0,0 +1,95 @@
+import os
+import shutil
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Каждая сборка пишет индекс и чанки в свою папку snapshots/<версия>, а файл CURRENT
+# указывает на активную версию. CURRENT подменяется атомарно (os.replace), поэтому
+# читатель видит либо старый снимок целиком, либо новый целиком
+SNAPSHOTS_DIR = "snapshots"
+CURRENT_FILE = "CURRENT"
+STAGING_SUFFIX = ".tmp" # Папка собираемого снимка, пока он не опубликован
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3")) # Сколько последних снимков хранить для отката
+
+
+def snapshots_root(store_dir):
+    return os.path.join(store_dir, SNAPSHOTS_DIR)
+
+
+def snapshot_path(store_dir, version):
+    return os.path.join(snapshots_root(store_dir), version)
+
+
+def current_version(store_dir):
+    """Версия активного снимка или None (сборок в формате снимков еще не было)."""
+    try:
+        with open(os.path.join(store_dir, CURRENT_FILE), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def resolve_store_dir(store_dir):
+    """(папка с файлами индекса, версия снимка). Без CURRENT — файлы прямо в store_dir, версия None."""
+    version = current_version(store_dir)
+    if version is None:
+        return store_dir, None
+    return snapshot_path(store_dir, version), version
+
+
+def list_snapshots(store_dir):
+    """Опубликованные снимки от старых к новым (версии сортируются по времени создания)."""
+    root = snapshots_root(store_dir)
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if not name.endswith(STAGING_SUFFIX) and os.path.isdir(os.path.join(root, name)))
+
+
+def new_snapshot_version(store_dir):
+    base = time.strftime("%Y%m%d-%H%M%S")
+    version, n = base, 1
+    while os.path.exists(snapshot_path(store_dir, version)) or os.path.exists(
+            snapshot_path(store_dir, version) + STAGING_SUFFIX):
+        n += 1
+        version = f"{base}-{n}"
+    return version
+
+
+def staging_path(store_dir, version):
+    return snapshot_path(store_dir, version) + STAGING_SUFFIX
+
+
+def set_current(store_dir, version):
+    """Атомарно делает снимок version активным (сборка, откат)."""
+    if not os.path.isdir(snapshot_path(store_dir, version)):
+        raise FileNotFoundError(f"Snapshot '{version}' not found in {snapshots_root(store_dir)}")
+    tmp_path = os.path.join(store_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(store_dir, CURRENT_FILE))
+
+
+def publish_snapshot(store_dir, version):
+    """Переименовывает собранную папку в snapshots/<version> и переключает CURRENT на нее."""
+    os.rename(staging_path(store_dir, version), snapshot_path(store_dir, version))
+    set_current(store_dir, version)
+
+
+def prune_snapshots(store_dir, keep=SNAPSHOT_KEEP):
+    """Удаляет старые снимки, оставляя keep последних и активный. Возвращает удаленные версии.
+
+    Процесс, который еще работает со старым снимком, продолжает читать его:
+    отображенные в память и открытые файлы живут до закрытия.
+    """
+    active = current_version(store_dir)
+    snapshots = list_snapshots(store_dir)
+    removed = [version for version in snapshots[:max(0, len(snapshots) - keep)] if version != active]
+    for version in removed:
+        shutil.rmtree(snapshot_path(store_dir, version), ignore_errors=True)
+    return removed
@@ -0,0 +1,42 @@
+import re
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s-]+", re.UNICODE)
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_question(text):
+    """Приводит вопрос к канонической форме: регистр, ё→е, без пунктуации и лишних пробелов."""
+    text = text.lower().replace("ё", "е")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _SPACES_RE.sub(" ", text).strip()
+
+
+_WORD_RE = re.compile(r"[a-zа-я0-9]+", re.UNICODE)
+
+# Окончания для облегченного стемминга русских слов (от длинных к коротким)
+_RU_ENDINGS = sorted([
+    "иями", "ями", "ами", "иях", "иям", "ием", "ией", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ая", "яя", "ое", "ее", "ые", "ие", "ой", "ей", "ий", "ый", "ую", "юю", "ом", "ем", "ам",
+    "ям", "ах", "ях", "ов", "ев", "ия", "ии", "ью",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+_MIN_STEM_LENGTH = 3
+
+STOP_WORDS = {"и", "в", "во", "на", "по", "для", "с", "со", "к", "о", "об", "от", "до", "из", "за", "не", "или", "как", "что"}
+
+
+def stem(word):
+    """Отрезает типичное русское окончание: "вакансии" и "вакансия" дают "ваканс"."""
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    """Разбивает текст на нормализованные слова (без стоп-слов)."""
+    return [word for word in _WORD_RE.findall(text.lower().replace("ё", "е")) if word not in STOP_WORDS]
+
+
+def stem_tokens(text):
+    return [stem(word) for word in tokenize(text)]
@@ -1,44 +1,175 @@
 import os
 import faiss
 import pickle
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
+from .batch_embedder import BatchEmbedder
+from .bm25 import BM25Index, reciprocal_rank_fusion
+from .chunk_store import CHUNK_STORE_FILE, ChunkStore, InMemoryChunks
+from .index_config import load_config, apply_search_params, make_search_params, normalize, read_index
+from .metrics import startup_phase
+from .snapshots import resolve_store_dir
+
 load_dotenv()
 
 VECTOR_STORE_DIR = "data/vector_store_cache/" # Относительно корня проекта
 FAISS_INDEX_PATH = os.path.join(VECTOR_STORE_DIR, "faiss_index.idx")
 METADATA_PATH = os.path.join(VECTOR_STORE_DIR, "metadata.pkl")
 
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+# torch — обычная модель; onnx / openvino — бэкенды sentence-transformers (>= 3.2), быстрее
+# загружаются и не тянут torch в память при инференсе; torch_int8 — динамическая
+# int8-квантизация линейных слоев (меньше памяти, быстрее на CPU, векторы чуть отличаются)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Файл модели внутри репозитория для onnx/openvino, например onnx/model_qint8_avx512_vnni.onnx
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE", "")
+# Гибридный поиск: векторный + BM25, слитые через reciprocal rank fusion (если сборщик сохранил постинги BM25)
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+# Сколько кандидатов берется из каждого списка перед слиянием
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+
+
+def load_embedding_model(model_name=EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND, model_file=EMBEDDING_MODEL_FILE):
+    # Импорт sentence_transformers (и torch) занимает секунды, поэтому только по требованию
+    from sentence_transformers import SentenceTransformer
+
+    if backend in ("onnx", "openvino"):
+        model_kwargs = {"file_name": model_file} if model_file else None
+        return SentenceTransformer(model_name, backend=backend, model_kwargs=model_kwargs)
+    if backend == "torch_int8":
+        import torch
+        model = SentenceTransformer(model_name, device="cpu")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}'. Use torch, torch_int8, onnx or openvino.")
+
+
 class VectorStore:
-    def __init__(self):
-        if not os.path.exists(FAISS_INDEX_PATH) or not os.path.exists(METADATA_PATH):
+    def __init__(self, store_dir=VECTOR_STORE_DIR, embedding_model=None):
+        # store_dir и embedding_model можно подменить (например, в бенчмарках).
+        # Файлы берутся из активного снимка store_dir (или прямо из store_dir у старых сборок)
+        self.store_dir = store_dir
+        snapshot_dir, self.snapshot_version = resolve_store_dir(store_dir)
+        store_dir = snapshot_dir
+        faiss_index_path = os.path.join(store_dir, os.path.basename(FAISS_INDEX_PATH))
+        chunk_store_path = os.path.join(store_dir, CHUNK_STORE_FILE)
+        metadata_path = os.path.join(store_dir, os.path.basename(METADATA_PATH))
+        if not os.path.exists(faiss_index_path) or not (
+                os.path.exists(chunk_store_path) or os.path.exists(metadata_path)):
             raise FileNotFoundError("FAISS index or metadata not found. Please run build_vector_store.py first.")
-            
-        self.index = faiss.read_index(FAISS_INDEX_PATH)
-        with open(METADATA_PATH, 'rb') as f:
-            data = pickle.load(f)
-            self.texts = data["texts"]
-            self.metadata = data["metadata"]
-        
-        embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
-        self.embedding_model = SentenceTransformer(embedding_model_name)
+
+        # Тип индекса и параметры поиска (nprobe, efSearch) сохраняет build_vector_store.py
+        self.index_config = load_config(store_dir)
+        with startup_phase("index_load"):
+            self.index = read_index(faiss_index_path, self.index_config)
+        apply_search_params(self.index, self.index_config)
+        self.higher_is_better = self.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        # Версия индекса меняется при каждой пересборке — по ней инвалидируется кэш ответов
+        if self.snapshot_version is not None:
+            self.index_version = self.snapshot_version
+        else:
+            index_stat = os.stat(faiss_index_path)
+            self.index_version = f"{index_stat.st_mtime_ns}-{index_stat.st_size}"
+        # Индекс хранит стабильные id чанков (IndexIDMap); тексты и метаданные читаются по id
+        with startup_phase("metadata_load"):
+            if os.path.exists(chunk_store_path):
+                self.chunks = ChunkStore(chunk_store_path)
+            else:
+                # Сборка старым сборщиком: все чанки в pickle, BM25 нет
+                with open(metadata_path, 'rb') as f:
+                    data = pickle.load(f)
+                self.chunks = InMemoryChunks(data.get("ids", range(len(data["texts"]))), data["texts"], data["metadata"])
+        self._topic_selectors = {}
+        self.bm25 = BM25Index(self.chunks.get_postings) if HYBRID_SEARCH and self.chunks.has_postings else None
+
+        if embedding_model is None:
+            with startup_phase("embedding_model_load"):
+                embedding_model = load_embedding_model()
+        self.embedding_model = embedding_model
+        self.batcher = BatchEmbedder(self) # Асинхронный API с микробатчингом
         print("VectorStore initialized.")
 
-    def search(self, query_text, k=5):
-        query_embedding = self.embedding_model.encode([query_text])
-        distances, indices = self.index.search(query_embedding, k)
-        
-        results = []
-        for i in range(len(indices[0])):
-            idx = indices[0][i]
-            if idx < len(self.texts): # Проверка на выход за пределы
-                 results.append({
-                    "text": self.texts[idx],
-                    "metadata": self.metadata[idx],
-                    "distance": distances[0][i]
-                })
-        return results
+    def close(self):
+        """Освобождает снимок: потоки батчера, соединение с chunks.sqlite и сам индекс."""
+        self.batcher.close()
+        self.chunks.close()
+        self.index = None
+        self._topic_selectors = {}
+
+    def embed_texts(self, texts):
+        embeddings = self.embedding_model.encode(texts)
+        # Для индексов по скалярному произведению векторы нормализуются (косинусная близость)
+        return normalize(embeddings) if self.index_config["normalize"] else embeddings
+
+    def embed_query(self, query_text):
+        return self.embed_texts([query_text])
+
+    def search(self, query_text, k=5, topic=None):
+        """k лучших чанков (dict с id, text, metadata, score) по запросу."""
+        query_embedding = self.embed_query(query_text)
+        candidates = self.candidate_count(k)
+        return self.fuse(self.search_by_embedding(query_embedding, candidates, topic),
+                         self.lexical_search(query_text, candidates, topic), k)
+
+    def search_by_embedding(self, query_embedding, k=5, topic=None):
+        return self.search_batch_by_embedding(query_embedding, k, topic)[0]
+
+    def search_batch_by_embedding(self, query_embeddings, k=5, topic=None):
+        """Для каждого запроса — [(id чанка, оценка)]; тексты не читаются (см. fuse)."""
+        params = self._search_params(topic)
+        if params is None:
+            distances, indices = self.index.search(query_embeddings, k)
+        else:
+            distances, indices = self.index.search(query_embeddings, k, params=params)
+        # FAISS возвращает -1, если соседей меньше k.
+        # Единая оценка релевантности: больше — лучше, независимо от метрики индекса
+        sign = 1.0 if self.higher_is_better else -1.0
+        return [[(int(chunk_id), sign * float(distance)) for chunk_id, distance in zip(indices[row], distances[row])
+                 if chunk_id >= 0]
+                for row in range(len(indices))]
+
+    def lexical_search(self, query_text, k=5, topic=None):
+        """Поиск BM25 по словам запроса: [(id чанка, оценка)]. Без постингов BM25 — пустой список."""
+        if self.bm25 is None:
+            return []
+        return self.bm25.search(query_text, k, self.topic_filter(topic))
+
+    def candidate_count(self, k):
+        """Сколько результатов брать из каждого поиска, чтобы после слияния осталось k лучших."""
+        return max(k, HYBRID_CANDIDATES) if self.bm25 is not None else k
+
+    def fuse(self, vector_results, lexical_results, k=5):
+        """Сливает результаты поисков и читает тексты и метаданные только для итоговых k чанков."""
+        if lexical_results:
+            hits = reciprocal_rank_fusion([vector_results, lexical_results], k)
+        else:
+            hits = vector_results[:k]
+        return self._load_chunks(hits)
+
+    def topic_filter(self, topic):
+        """Массив id чанков темы или None (искать по всему индексу, в том числе для неизвестной темы)."""
+        if not topic:
+            return None
+        return self.chunks.ids_for_topic(topic)
+
+    def _search_params(self, topic):
+        ids = self.topic_filter(topic)
+        if ids is None:
+            return None
+        selector = self._topic_selectors.get(topic.casefold())
+        if selector is None:
+            # FAISS пропускает векторы чужих тем еще до вычисления расстояний
+            selector = self._topic_selectors[topic.casefold()] = faiss.IDSelectorBatch(ids)
+        # Параметры создаются на каждый поиск: IndexIDMap::search на время вызова подменяет
+        # в них sel, и общий объект ломал бы одновременные поиски из разных потоков.
+        # Селектор же только читается — его кэшируем (параметры ссылаются на него, но не владеют им)
+        return make_search_params(self.index_config, selector)
+
+    def _load_chunks(self, hits):
+        chunks = self.chunks.get_many(chunk_id for chunk_id, _ in hits)
+        return [{"id": chunk_id, "text": chunks[chunk_id][0], "metadata": chunks[chunk_id][1], "score": score}
+                for chunk_id, score in hits if chunk_id in chunks]
 
 # Пример использования (для отладки)
 if __name__ == '__main__':
@@ -50,7 +181,7 @@ if __name__ == '__main__':
         search_results = store.search(sample_query)
         print(f"Search results for '{sample_query}':")
         for res in search_results:
-            print(f"  Topic: {res['metadata']['topic']}, Source: {res['metadata']['source'][:30]}..., Distance: {res['distance']:.4f}")
+            print(f"  Topic: {res['metadata']['topic']}, Source: {res['metadata']['source'][:30]}..., Score: {res['score']:.4f}")
             # print(f"  Text: {res['text'][:100]}...") # Раскомментировать для вывода текста
     except FileNotFoundError as e:
         print(e)
@@ -0,0 +1,366 @@
+"""Офлайн-бенчмарк поиска и всего конвейера ответа.
+
+Генерирует синтетические корпуса заданного размера, собирает по ним индекс
+через build_vector_store, измеряет время сборки и пиковую память, задержку и
+QPS VectorStore.search при разных k и уровнях конкурентности, а также
+RAGProcessor.stream_answer против локального фейкового LLM.
+Работает полностью офлайн на CPU: по умолчанию эмбеддинги считаются
+детерминированным хэширующим энкодером, реальную модель можно взять из
+локального кэша HuggingFace через --embedding-model.
+
+Запуск из корня проекта:
+    python scripts/benchmark.py run --sizes 200,2000 --output bench_base.json
+    python scripts/benchmark.py compare bench_base.json bench_new.json --threshold 0.1
+"""
+import os
+import sys
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+from queue import Empty
+
+# Никаких обращений к сети: модели только из локального кэша
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from core.index_config import INDEX_TYPES, make_config
+
+TOPICS = ["Найм", "Продажи", "Финансы", "Управление", "Горничные"]
+VOCABULARY = (
+    "горничная уборка найм вакансия менеджер продажи цена гость отзыв бронирование квартира "
+    "авито ota суточная аренда заселение выселение ключи постельное белье чек-лист регламент "
+    "собеседование зарплата премия штраф загрузка сезон скидка депозит договор собственник "
+    "ремонт мебель техника интернет сервис жалоба звонок сообщение оплата касса отчет"
+).split()
+QUESTION_TEMPLATES = [
+    "Как {0} {1}?", "Что важно при {0} {1}?", "Расскажи про {0} и {1}", "Где найти {0} для {1}?",
+]
+# Метрики, рост которых — регрессия (задержки, время, память); для остальных регрессия — падение.
+# Совпадает и с суффиксом имени: wall_seconds — тоже время
+LOWER_IS_BETTER = ("p50", "p95", "p99", "mean", "seconds", "peak_rss_mb", "ttft")
+
+
+class HashingEmbedder:
+    """Детерминированный "мешок слов" через хэширование — заменяет модель, когда ее нет локально."""
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False, **kwargs):
+        vectors = np.zeros((len(texts), self.dimension), dtype="float32")
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dimension
+                vectors[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+        return vectors
+
+
+def load_embedder(model_name):
+    if not model_name:
+        return HashingEmbedder()
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+def generate_corpus(texts_dir, documents, seed, words_per_document=400):
+    rng = random.Random(seed)
+    for doc in range(documents):
+        topic = TOPICS[doc % len(TOPICS)]
+        os.makedirs(os.path.join(texts_dir, topic), exist_ok=True)
+        sentences = []
+        for _ in range(words_per_document // 10):
+            sentence = " ".join(rng.choice(VOCABULARY) for _ in range(10))
+            sentences.append(sentence.capitalize() + ".")
+        with open(os.path.join(texts_dir, topic, f"lesson_{doc:06d}.txt"), 'w', encoding='utf-8') as f:
+            f.write(" ".join(sentences))
+
+
+def generate_questions(count, seed):
+    rng = random.Random(seed)
+    return [rng.choice(QUESTION_TEMPLATES).format(rng.choice(VOCABULARY), rng.choice(VOCABULARY)) + f" #{i}"
+            for i in range(count)]
+
+
+def summarize(latencies, elapsed=None):
+    latencies = np.asarray(latencies, dtype="float64")
+    summary = {
+        "count": int(len(latencies)),
+        "mean": float(latencies.mean()),
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99)),
+    }
+    if elapsed:
+        summary["qps"] = len(latencies) / elapsed
+    return summary
+
+
+def _build_in_child(texts_dir, store_dir, index_config, embedding_model_name, queue):
+    from build_vector_store import build_vector_store
+    summary = build_vector_store(texts_dir, store_dir, index_config, full=True,
+                                 embedding_model=load_embedder(embedding_model_name))
+    summary["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(summary)
+
+
+def benchmark_build(texts_dir, store_dir, index_config, embedding_model_name):
+    """Сборка в отдельном процессе, чтобы честно измерить ее пиковую память."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_build_in_child,
+                              args=(texts_dir, store_dir, index_config, embedding_model_name, queue))
+    started = time.perf_counter()
+    process.start()
+    # Если дочерний процесс упал (исключение, OOM killer), результата не будет:
+    # не ждем его вечно, а проверяем, жив ли процесс
+    while True:
+        try:
+            summary = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                try:
+                    summary = queue.get(timeout=1) # Результат мог прийти перед самым выходом
+                    break
+                except Empty:
+                    raise RuntimeError(f"Index build process exited with code {process.exitcode} "
+                                       f"without a result") from None
+    process.join()
+    summary["wall_seconds"] = time.perf_counter() - started
+    return {key: summary[key] for key in ("documents", "chunks", "seconds", "wall_seconds", "peak_rss_mb", "stages")}
+
+
+def benchmark_search(store, questions, k_values):
+    results = {}
+    store.search(questions[0], k=max(k_values)) # Прогрев
+    for k in k_values:
+        latencies = []
+        started = time.perf_counter()
+        for question in questions:
+            t0 = time.perf_counter()
+            store.search(question, k=k)
+            latencies.append(time.perf_counter() - t0)
+        results[f"k={k}"] = summarize(latencies, time.perf_counter() - started)
+    return results
+
+
+async def _run_concurrently(concurrency, questions, handle):
+    queue = asyncio.Queue()
+    for question in questions:
+        queue.put_nowait(question)
+    latencies = []
+
+    async def client():
+        while not queue.empty():
+            question = queue.get_nowait()
+            t0 = time.perf_counter()
+            await handle(question)
+            latencies.append(time.perf_counter() - t0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started
+
+
+async def benchmark_concurrent_search(store, questions, k, concurrency_levels):
+    """Асинхронный путь бота: микробатчинг эмбеддингов и поиска."""
+    results = {}
+
+    async def handle(question):
+        embedding = await store.batcher.embed(question)
+        await store.batcher.search(embedding, k)
+
+    for concurrency in concurrency_levels:
+        latencies, elapsed = await _run_concurrently(concurrency, questions, handle)
+        results[f"c={concurrency}"] = summarize(latencies, elapsed)
+    return results
+
+
+async def benchmark_end_to_end(store, questions, concurrency_levels, llm_ttft, llm_token_delay):
+    from aiohttp import web
+    from fake_openai_server import create_app
+    from core.answer_cache import AnswerCache
+    from core.llm_service import LLMService
+    from core.rag_processor import RAGProcessor
+
+    runner = web.AppRunner(create_app(ttft=llm_ttft, token_delay=llm_token_delay))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    if not os.getenv("OPENAI_API_KEY"):
+        os.environ["OPENAI_API_KEY"] = "benchmark" # Фейковому серверу ключ не важен
+
+    results = {}
+    try:
+        llm_service = LLMService()
+        for concurrency in concurrency_levels:
+            # Кэш ответов выключен (размер 0), иначе меряли бы его, а не конвейер
+            rag = RAGProcessor(vector_store=store, llm_service=llm_service,
+                               answer_cache=AnswerCache(max_size=0, persist_path="", shared_url=""))
+            ttfts = []
+
+            async def handle(question):
+                t0 = time.perf_counter()
+                first = True
+                async for _delta in rag.stream_answer(question):
+                    if first:
+                        ttfts.append(time.perf_counter() - t0)
+                        first = False
+
+            latencies, elapsed = await _run_concurrently(concurrency, questions, handle)
+            results[f"c={concurrency}"] = dict(summarize(latencies, elapsed), ttft=summarize(ttfts))
+        await llm_service.aclose()
+    finally:
+        await runner.cleanup()
+    return results
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def run(args):
+    from core.vector_store import VectorStore
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "embedding_model": args.embedding_model or "hashing",
+            "index_type": args.index_type,
+            "llm_ttft": args.llm_ttft,
+            "llm_token_delay": args.llm_token_delay,
+        },
+        "results": {},
+    }
+    work_dir = tempfile.mkdtemp(prefix="rag_bench_")
+    embedder = load_embedder(args.embedding_model)
+    try:
+        for size in args.sizes:
+            print(f"=== Corpus of {size} documents ===")
+            texts_dir = os.path.join(work_dir, f"texts_{size}")
+            store_dir = os.path.join(work_dir, f"store_{size}")
+            generate_corpus(texts_dir, size, args.seed)
+
+            result = {"build": benchmark_build(texts_dir, store_dir, make_config(args.index_type), args.embedding_model)}
+            print(f"Build: {result['build']['seconds']:.2f}s, peak RSS {result['build']['peak_rss_mb']:.0f} MB")
+
+            store = VectorStore(store_dir=store_dir, embedding_model=embedder)
+            questions = generate_questions(args.queries, args.seed)
+            result["search"] = benchmark_search(store, questions, args.k)
+            result["concurrent_search"] = asyncio.run(
+                benchmark_concurrent_search(store, questions, 5, args.concurrency))
+            if not args.skip_e2e:
+                result["e2e"] = asyncio.run(benchmark_end_to_end(
+                    store, questions[:args.e2e_queries], args.concurrency, args.llm_ttft, args.llm_token_delay))
+            for section in ("search", "concurrent_search", "e2e"):
+                for name, summary in result.get(section, {}).items():
+                    print(f"{section:<18} {name:<6} p50={summary['p50'] * 1000:8.2f}ms "
+                          f"p99={summary['p99'] * 1000:8.2f}ms qps={summary['qps']:10.1f}")
+            report["results"][str(size)] = result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"Results saved to {args.output}")
+
+
+def flatten(data, prefix=""):
+    flat = {}
+    for key, value in data.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def is_lower_better(path):
+    suffixes = tuple("_" + name for name in LOWER_IS_BETTER)
+    return any(part in LOWER_IS_BETTER or part.endswith(suffixes) for part in path.split("."))
+
+
+def compare(args):
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = flatten(json.load(f)["results"])
+    with open(args.candidate, 'r', encoding='utf-8') as f:
+        candidate = flatten(json.load(f)["results"])
+
+    regressions = []
+    for path in sorted(set(baseline) & set(candidate)):
+        metric = path.rsplit(".", 1)[-1]
+        if metric in ("count", "documents", "chunks") or ".stages." in path:
+            continue
+        old, new = baseline[path], candidate[path]
+        if not old:
+            continue
+        change = (new - old) / old
+        worse = change > args.threshold if is_lower_better(path) else change < -args.threshold
+        marker = "REGRESSION" if worse else ""
+        if worse or args.verbose:
+            print(f"{path:<55} {old:>12.4f} -> {new:>12.4f} ({change:+.1%}) {marker}")
+        if worse:
+            regressions.append(path)
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.threshold:.0%}.")
+        sys.exit(1)
+    print("No regressions.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval and answer pipeline benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Запустить бенчмарк")
+    run_parser.add_argument("--sizes", type=int_list, default=[200, 2000], help="Размеры корпусов (число документов)")
+    run_parser.add_argument("--k", type=int_list, default=[1, 5, 10])
+    run_parser.add_argument("--concurrency", type=int_list, default=[1, 8, 32])
+    run_parser.add_argument("--queries", type=int, default=300)
+    run_parser.add_argument("--e2e-queries", type=int, default=100)
+    run_parser.add_argument("--skip-e2e", action="store_true")
+    run_parser.add_argument("--llm-ttft", type=float, default=0.3, help="Задержка фейкового LLM до первого токена, сек")
+    run_parser.add_argument("--llm-token-delay", type=float, default=0.005)
+    run_parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat_ip")
+    run_parser.add_argument("--embedding-model", help="Модель из локального кэша HF; по умолчанию хэширующий энкодер")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", default="bench_output.json")
+
+    compare_parser = subparsers.add_parser("compare", help="Сравнить два прогона и найти регрессии")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Допустимое ухудшение (доля)")
+    compare_parser.add_argument("--verbose", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,528 @@
 import os
+import sys
+import argparse
+import hashlib
+import json
+import shutil
+import sqlite3
+import time
 import faiss
 import pickle
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from sentence_transformers import SentenceTransformer
 from langchain.text_splitter import RecursiveCharacterTextSplitter # Можно использовать и свой простой сплиттер
 from dotenv import load_dotenv
 
+# Добавляем корень проекта в PYTHONPATH, чтобы импортировать core
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from core.chunk_store import CHUNK_STORE_FILE, ChunkStore, ChunkStoreWriter, InMemoryChunks
+from core.index_config import (
+    INDEX_TYPES, DEFAULT_INDEX_TYPE, VECTOR_STORAGES, DEFAULT_VECTOR_STORAGE, INDEX_CONFIG_FILE, make_config, build_params, create_index,
+    needs_training, supports_remove, normalize, save_config,
+)
+from core.snapshots import (
+    new_snapshot_version, staging_path, publish_snapshot, prune_snapshots, resolve_store_dir, SNAPSHOT_KEEP,
+)
+
 load_dotenv()
 
 TEXTS_DIR = "../data/knowledge_base/texts/"
+# Сами индекс, чанки и манифест лежат в снимке VECTOR_STORE_DIR/snapshots/<версия>/ (см. core/snapshots.py),
+# кэш эмбеддингов — прямо в VECTOR_STORE_DIR, он общий для всех снимков
 VECTOR_STORE_DIR = "../data/vector_store_cache/"
-FAISS_INDEX_PATH = os.path.join(VECTOR_STORE_DIR, "faiss_index.idx")
-METADATA_PATH = os.path.join(VECTOR_STORE_DIR, "metadata.pkl")
+FAISS_INDEX_FILE = "faiss_index.idx"
+METADATA_FILE = "metadata.pkl" # Формат прошлых сборок; теперь чанки лежат в CHUNK_STORE_FILE
+LEGACY_BM25_FILE = "bm25.pkl"
+# Манифест: хэши файлов и их чанков + id чанков в индексе, для инкрементальной пересборки
+MANIFEST_FILE = "manifest.json"
+# Кэш эмбеддингов чанков по хэшу текста (переживает пересборки). SQLite, чтобы не держать его в памяти целиком
+EMBEDDING_CACHE_FILE = "embedding_cache.sqlite"
+EMBEDDING_CACHE_PATH = os.path.join(VECTOR_STORE_DIR, EMBEDDING_CACHE_FILE)
+
+SUPPORTED_EXTENSIONS = (".txt", ".pdf", ".docx")
+CHUNK_SIZE = 1000  # Размер чанка (в символах)
+CHUNK_OVERLAP = 200 # Перекрытие между чанками
+EMBED_BATCH_SIZE = 256 # Сколько чанков кодируется и добавляется в индекс за раз
+IVF_TRAIN_SIZE = 50000 # Сколько первых векторов копится для обучения IVF при полной сборке
 
-# Убедимся, что директория для векторного хранилища существует
-os.makedirs(VECTOR_STORE_DIR, exist_ok=True)
+def sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-def load_documents(base_path):
+def discover_documents(base_path):
     docs = []
     for root, _, files in os.walk(base_path):
-        for file_name in files:
-            if file_name.endswith(".txt"):
-                file_path = os.path.join(root, file_name)
+        for file_name in sorted(files):
+            if file_name.lower().endswith(SUPPORTED_EXTENSIONS):
                 topic = os.path.basename(root) # Получаем название папки как тему
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        text = f.read()
-                        docs.append({"text": text, "source": file_path, "topic": topic})
-                except Exception as e:
-                    print(f"Error reading {file_path}: {e}")
+                docs.append({"source": os.path.join(root, file_name), "topic": topic})
     return docs
 
+def extract_text(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".pdf":
+        from pypdf import PdfReader # Необязательная зависимость, нужна только для PDF
+        reader = PdfReader(file_path)
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+    if extension == ".docx":
+        import docx # python-docx, тоже необязательная
+        return "\n".join(paragraph.text for paragraph in docx.Document(file_path).paragraphs)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def hash_and_extract(file_path, known_hash):
+    """Выполняется в процессе пула: хэш файла и (если файл изменился) его текст."""
+    try:
+        with open(file_path, 'rb') as f:
+            file_hash = hashlib.sha256(f.read()).hexdigest()
+        if file_hash == known_hash:
+            return file_hash, None, None
+        return file_hash, extract_text(file_path), None
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+
+def bounded_map(pool, fn, jobs, window):
+    """Как pool.map, но держит в работе не больше window задач и отдает результаты по мере готовности."""
+    jobs = iter(jobs)
+    in_flight = {}
+    for job in jobs:
+        in_flight[pool.submit(fn, *job[1])] = job[0]
+        if len(in_flight) >= window:
+            break
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield in_flight.pop(future), future.result()
+            job = next(jobs, None)
+            if job is not None:
+                in_flight[pool.submit(fn, *job[1])] = job[0]
+
+class StageStats:
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, stage, count, seconds):
+        total_count, total_seconds = self.stats.get(stage, (0, 0.0))
+        self.stats[stage] = (total_count + count, total_seconds + seconds)
+
+    def report(self):
+        units = {"extract": "files", "chunk": "chunks", "embed": "embeddings", "index": "vectors"}
+        for stage, (count, seconds) in self.stats.items():
+            rate = count / seconds if seconds else float("inf")
+            print(f"  {stage:<8} {count:>8} {units.get(stage, 'items'):<10} in {seconds:8.2f}s  ({rate:,.1f}/s)")
+
+class EmbeddingCache:
+    def __init__(self, path, model_name):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+        if row is None or row[0] != model_name:
+            # Эмбеддинги другой модели несовместимы — начинаем заново
+            self.conn.execute("DELETE FROM embeddings")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('model', ?)", (model_name,))
+        self.conn.commit()
+
+    def get_many(self, hashes):
+        found = {}
+        hashes = list(hashes)
+        for start in range(0, len(hashes), 500): # Ограничение SQLite на число параметров
+            part = hashes[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT hash, vector FROM embeddings WHERE hash IN ({','.join('?' * len(part))})", part
+            )
+            for chunk_hash, blob in rows:
+                found[chunk_hash] = np.frombuffer(blob, dtype="float32")
+        return found
+
+    def put_many(self, items):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+            ((h, np.asarray(v, dtype="float32").tobytes()) for h, v in items.items()),
+        )
+        self.conn.commit()
+
+    def prune(self, live_hashes):
+        """Оставляет только эмбеддинги живых чанков, чтобы кэш не рос бесконечно."""
+        self.conn.execute("CREATE TEMP TABLE live (hash TEXT PRIMARY KEY)")
+        self.conn.executemany("INSERT OR IGNORE INTO live VALUES (?)", ((h,) for h in live_hashes))
+        self.conn.execute("DELETE FROM embeddings WHERE hash NOT IN (SELECT hash FROM live)")
+        self.conn.execute("DROP TABLE live")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class IndexWriter:
+    """Добавляет векторы в индекс по мере поступления батчей.
+
+    IVF-индексам и int8-хранилищу нужно обучение: при полной сборке первые векторы копятся
+    (не больше IVF_TRAIN_SIZE), индекс обучается на них, дальше векторы
+    добавляются сразу.
+    """
+
+    def __init__(self, index_config, index=None):
+        self.index_config = index_config
+        self.index = index
+        self._buffer_vectors = []
+        self._buffer_ids = []
+        self._buffered = 0
+
+    def add(self, vectors, ids):
+        if self.index is None and needs_training(self.index_config):
+            self._buffer_vectors.append(vectors)
+            self._buffer_ids.append(ids)
+            self._buffered += len(ids)
+            if self._buffered >= IVF_TRAIN_SIZE:
+                self._train_and_flush()
+            return
+        if self.index is None:
+            self.index = create_index(self.index_config, vectors.shape[1])
+        self.index.add_with_ids(vectors, ids)
+
+    def _train_and_flush(self):
+        vectors = np.vstack(self._buffer_vectors)
+        ids = np.concatenate(self._buffer_ids)
+        self._buffer_vectors, self._buffer_ids, self._buffered = [], [], 0
+        print(f"Training {self.index_config['index_type']} index on {len(vectors)} vectors...")
+        self.index = create_index(self.index_config, vectors.shape[1], vectors)
+        self.index.add_with_ids(vectors, ids)
+
+    def finish(self):
+        if self._buffered:
+            self._train_and_flush()
+        return self.index
+
+def open_chunks(store_dir):
+    """Чанки прошлой сборки: ChunkStore или (для старых сборок) metadata.pkl. None, если их нет."""
+    chunk_store_path = os.path.join(store_dir, CHUNK_STORE_FILE)
+    if os.path.exists(chunk_store_path):
+        return ChunkStore(chunk_store_path)
+    metadata_path = os.path.join(store_dir, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        with open(metadata_path, 'rb') as f:
+            data = pickle.load(f)
+        return InMemoryChunks(data["ids"], data["texts"], data["metadata"])
+    return None
+
+def load_manifest(store_dir, embedding_model_name, index_config):
+    """Возвращает манифест прошлой сборки или None, если инкрементальная сборка невозможна."""
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path) or not os.path.exists(os.path.join(store_dir, FAISS_INDEX_FILE)):
+        return None
+    if not any(os.path.exists(os.path.join(store_dir, name)) for name in (CHUNK_STORE_FILE, METADATA_FILE)):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get("model") != embedding_model_name:
+        print("Embedding model changed since the last build, doing a full rebuild.")
+        return None
+    # Сборки до появления хранения float16/int8 — float32
+    if dict({"storage": "float32"}, **manifest.get("index", {})) != build_params(index_config):
+        print("Index type or parameters changed since the last build, doing a full rebuild.")
+        return None
+    return manifest
+
 def main():
-    print("Loading documents...")
-    documents = load_documents(TEXTS_DIR)
+    parser = argparse.ArgumentParser(description="Build or incrementally update the FAISS vector store")
+    parser.add_argument("--full", action="store_true", help="Полная пересборка индекса без учета прошлой сборки")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Число процессов для извлечения текста")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Размер батча эмбеддингов")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=DEFAULT_INDEX_TYPE)
+    parser.add_argument("--nlist", type=int, help="IVF: число кластеров")
+    parser.add_argument("--nprobe", type=int, help="IVF: число просматриваемых кластеров при поиске")
+    parser.add_argument("--pq-m", type=int, help="IVF-PQ: число подквантователей")
+    parser.add_argument("--m", type=int, help="HNSW: число связей на вершину")
+    parser.add_argument("--ef-construction", type=int, help="HNSW: efConstruction")
+    parser.add_argument("--ef-search", type=int, help="HNSW: efSearch")
+    parser.add_argument("--storage", choices=VECTOR_STORAGES, default=DEFAULT_VECTOR_STORAGE,
+                        help="Хранение векторов: float32, float16 или int8 (не для ivf_pq)")
+    parser.add_argument("--keep", type=int, default=SNAPSHOT_KEEP, help="Сколько последних снимков хранить для отката")
+    args = parser.parse_args()
+
+    index_config = make_config(
+        args.index_type, nlist=args.nlist, nprobe=args.nprobe, pq_m=args.pq_m,
+        m=args.m, ef_construction=args.ef_construction, ef_search=args.ef_search,
+        storage=args.storage,
+    )
+    build_vector_store(TEXTS_DIR, VECTOR_STORE_DIR, index_config, full=args.full,
+                       workers=args.workers, batch_size=args.batch_size, keep=args.keep)
+
+def build_vector_store(texts_dir, store_dir, index_config, full=False, workers=1,
+                       batch_size=EMBED_BATCH_SIZE, embedding_model=None, keep=SNAPSHOT_KEEP):
+    """Собирает (или обновляет) векторное хранилище в store_dir. Возвращает сводку сборки.
+
+    Результат — новый снимок, который становится активным только целиком записанным;
+    запущенный бот подхватывает его сам. Инкрементальная сборка берет за основу активный снимок.
+    Тексты чанков сразу пишутся в файл снимка, поэтому память сборки не растет с размером базы.
+    embedding_model — уже загруженная модель с методом encode (например, для бенчмарков);
+    по умолчанию SentenceTransformer из EMBEDDING_MODEL_NAME загружается при первой необходимости.
+    """
+    # Убедимся, что директория для векторного хранилища существует
+    os.makedirs(store_dir, exist_ok=True)
+    previous_dir, previous_version = resolve_store_dir(store_dir)
+    stats = StageStats()
+    build_started = time.perf_counter()
+
+    print("Discovering documents...")
+    documents = discover_documents(texts_dir)
     if not documents:
         print("No documents found. Exiting.")
-        return
+        return None
 
-    print(f"Loaded {len(documents)} documents.")
+    print(f"Found {len(documents)} documents.")
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,  # Размер чанка (в символах)
-        chunk_overlap=200 # Перекрытие между чанками
-    )
-    
-    all_chunks_text = []
-    metadata = []
-    
-    for doc_idx, doc in enumerate(documents):
-        chunks = text_splitter.split_text(doc["text"])
-        for chunk_idx, chunk_text in enumerate(chunks):
-            all_chunks_text.append(chunk_text)
-            metadata.append({
-                "source": doc["source"],
-                "topic": doc["topic"],
-                "chunk_id": f"doc{doc_idx}_chunk{chunk_idx}" 
-            })
-
-    if not all_chunks_text:
-        print("No text chunks generated. Exiting.")
-        return
-        
-    print(f"Generated {len(all_chunks_text)} chunks.")
-
-    print("Loading embedding model...")
-    # Используем SentenceTransformer для локальных эмбеддингов
-    # Если используете OpenAI, нужно будет адаптировать под их API
     embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
-    model = SentenceTransformer(embedding_model_name)
+    manifest = None if full else load_manifest(previous_dir, embedding_model_name, index_config)
+    embedding_cache = EmbeddingCache(os.path.join(store_dir, EMBEDDING_CACHE_FILE), embedding_model_name)
+
+    if manifest is not None:
+        print("Incremental build: comparing with the previous manifest...")
+        index = faiss.read_index(os.path.join(previous_dir, FAISS_INDEX_FILE)) # Без mmap: индекс будет изменяться
+        previous_chunks = open_chunks(previous_dir) # Неизменные чанки переносятся из него в конце сборки
+    else:
+        print("Full build.")
+        manifest = {"model": embedding_model_name, "index": build_params(index_config), "next_id": 0, "files": {}}
+        index = None
+        previous_chunks = None
+
+    # Снимок собирается в отдельной папке; если сборка не дошла до публикации, папка удаляется
+    version = new_snapshot_version(store_dir)
+    snapshot_dir = staging_path(store_dir, version)
+    os.makedirs(snapshot_dir)
+    chunk_writer = ChunkStoreWriter(os.path.join(snapshot_dir, CHUNK_STORE_FILE))
+    published = False
+    built_chunks = None
+    try:
+        # HNSW не умеет удалять векторы: при инкрементальной сборке новые векторы
+        # добавляются в конце, а при удалениях индекс пересобирается из кэша эмбеддингов
+        defer_index_updates = index is not None and not supports_remove(index_config)
+        writer = IndexWriter(index_config, index)
+        model = embedding_model
+
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP
+        )
+
+        old_files = manifest["files"]
+        new_files = {}
+        removed_ids = []
+        new_chunks = [] # (chunk_id, chunk_hash) новых и измененных чанков
+        pending = [] # (chunk_id, chunk_hash, text), ожидающие эмбеддинга и добавления в индекс
+        kept_chunks = 0
+        reused_chunks = 0
+        computed_chunks = 0
+
+        def embed_missing(missing):
+            """Считает эмбеддинги {хэш: текст}, которых нет в кэше, и кладет их в кэш."""
+            nonlocal model, computed_chunks
+            if model is None:
+                print("Loading embedding model...")
+                # Используем SentenceTransformer для локальных эмбеддингов
+                # Если используете OpenAI, нужно будет адаптировать под их API
+                model = SentenceTransformer(embedding_model_name)
+            started = time.perf_counter()
+            missing_hashes = list(missing)
+            embeddings = model.encode([missing[h] for h in missing_hashes], batch_size=64)
+            stats.add("embed", len(missing_hashes), time.perf_counter() - started)
+            computed = dict(zip(missing_hashes, embeddings))
+            embedding_cache.put_many(computed)
+            computed_chunks += len(missing_hashes)
+            return computed
+
+        def flush_pending():
+            nonlocal reused_chunks
+            if not pending:
+                return
+            hashes = [chunk_hash for _, chunk_hash, _ in pending]
+            vectors_by_hash = embedding_cache.get_many(set(hashes))
+            missing = {chunk_hash: text for _, chunk_hash, text in pending if chunk_hash not in vectors_by_hash}
+            reused_chunks += len(pending) - sum(1 for _, chunk_hash, _ in pending if chunk_hash in missing)
+            if missing:
+                vectors_by_hash.update(embed_missing(missing))
+
+            if not defer_index_updates:
+                started = time.perf_counter()
+                vectors = np.vstack([vectors_by_hash[h] for h in hashes]).astype("float32")
+                if index_config["normalize"]:
+                    vectors = normalize(vectors)
+                writer.add(vectors, np.array([chunk_id for chunk_id, _, _ in pending], dtype="int64"))
+                stats.add("index", len(pending), time.perf_counter() - started)
+            pending.clear()
+
+        print(f"Extracting texts with {workers} workers...")
+        jobs = (
+            (doc, (doc["source"], old_files.get(os.path.relpath(doc["source"], texts_dir), {}).get("sha256")))
+            for doc in documents
+        )
+        extract_started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for doc, (file_hash, text, error) in bounded_map(pool, hash_and_extract, jobs, window=workers * 4):
+                rel_source = os.path.relpath(doc["source"], texts_dir)
+                previous = old_files.get(rel_source)
+                if error is not None:
+                    print(f"Error reading {doc['source']}: {error}")
+                    if previous is not None:
+                        new_files[rel_source] = previous # Оставляем прошлую версию, а не удаляем файл из индекса
+                        kept_chunks += len(previous["chunks"])
+                    continue
+                if text is None:
+                    new_files[rel_source] = previous # Файл не изменился — чанки остаются в индексе как есть
+                    kept_chunks += len(previous["chunks"])
+                    continue
+
+                if previous is not None:
+                    removed_ids.extend(chunk["id"] for chunk in previous["chunks"])
+
+                started = time.perf_counter()
+                file_chunks = []
+                for chunk_idx, chunk_text in enumerate(text_splitter.split_text(text)):
+                    chunk_id = manifest["next_id"]
+                    manifest["next_id"] += 1
+                    chunk_hash = sha256(chunk_text)
+                    chunk_writer.add(chunk_id, chunk_text, {
+                        "source": doc["source"],
+                        "topic": doc["topic"],
+                        "chunk_id": chunk_id,
+                        "chunk_index": chunk_idx,
+                        "chunk_hash": chunk_hash,
+                    })
+                    file_chunks.append({"id": chunk_id, "sha256": chunk_hash})
+                    new_chunks.append((chunk_id, chunk_hash))
+                    pending.append((chunk_id, chunk_hash, chunk_text))
+                stats.add("chunk", len(file_chunks), time.perf_counter() - started)
+                new_files[rel_source] = {"sha256": file_hash, "chunks": file_chunks}
+
+                if len(pending) >= batch_size:
+                    flush_pending()
+        stats.add("extract", len(documents), time.perf_counter() - extract_started)
+        flush_pending()
+
+        # Удаленные файлы
+        for rel_source, previous in old_files.items():
+            if rel_source not in new_files:
+                removed_ids.extend(chunk["id"] for chunk in previous["chunks"])
+
+        total_chunks = kept_chunks + len(new_chunks)
+        if not total_chunks:
+            print("No text chunks generated. Exiting.")
+            return None
+
+        print(f"Chunks: {kept_chunks} unchanged, {len(new_chunks)} new/changed, {len(removed_ids)} removed.")
+        if previous_version is not None and index is not None and not new_chunks and not removed_ids:
+            print(f"Nothing changed, snapshot {previous_version} stays active.")
+            return {
+                "documents": len(documents),
+                "chunks": total_chunks,
+                "reused_embeddings": kept_chunks,
+                "computed_embeddings": 0,
+                "seconds": time.perf_counter() - build_started,
+                "snapshot": previous_version,
+                "stages": {stage: {"count": count, "seconds": seconds} for stage, (count, seconds) in stats.stats.items()},
+            }
+
+        def live_chunks():
+            """(id, хэш) всех чанков нового снимка по манифесту, по порядку id."""
+            return sorted((chunk["id"], chunk["sha256"]) for info in new_files.values() for chunk in info["chunks"])
+
+        # Неизменные чанки переносятся из прошлого снимка без чтения в память (у старых сборок
+        # с metadata.pkl они и так в памяти). Лексический индекс дешев по сравнению
+        # с эмбеддингами, поэтому всегда строится заново целиком
+        print(f"Saving chunks to {chunk_writer.path}")
+        started = time.perf_counter()
+        if isinstance(previous_chunks, ChunkStore):
+            chunk_writer.copy_from(previous_chunks.path, removed_ids)
+        elif previous_chunks is not None:
+            removed = set(removed_ids)
+            for chunk_id, text, meta in previous_chunks.iter_chunks():
+                if chunk_id not in removed:
+                    chunk_writer.add(chunk_id, text, meta)
+        chunk_writer.finish()
+        stats.add("bm25", total_chunks, time.perf_counter() - started)
+        built_chunks = ChunkStore(chunk_writer.path)
+
+        def add_from_cache(target_writer, chunks):
+            # Кэш эмбеддингов не обязателен: если вектора нет (кэш удален или от другой модели),
+            # текст чанка берется из уже записанного chunks.sqlite снимка и кодируется заново
+            nonlocal reused_chunks
+            for start in range(0, len(chunks), batch_size):
+                batch = chunks[start:start + batch_size]
+                hashes = [chunk_hash for _, chunk_hash in batch]
+                vectors_by_hash = embedding_cache.get_many(set(hashes))
+                missing_ids = [chunk_id for chunk_id, chunk_hash in batch if chunk_hash not in vectors_by_hash]
+                if missing_ids:
+                    reused_chunks -= len(missing_ids) # Неизмененные чанки, которые все же пришлось кодировать
+                    texts = built_chunks.get_many(missing_ids)
+                    vectors_by_hash.update(embed_missing(
+                        {texts[chunk_id][1]["chunk_hash"]: texts[chunk_id][0] for chunk_id in missing_ids}))
+                vectors = np.vstack([vectors_by_hash[h] for h in hashes]).astype("float32")
+                if index_config["normalize"]:
+                    vectors = normalize(vectors)
+                target_writer.add(vectors, np.array([chunk_id for chunk_id, _ in batch], dtype="int64"))
 
-    print("Generating embeddings...")
-    embeddings = model.encode(all_chunks_text, show_progress_bar=True)
+        if defer_index_updates:
+            started = time.perf_counter()
+            if removed_ids:
+                print(f"Index type {index_config['index_type']} does not support removals, rebuilding it from cached embeddings.")
+                writer = IndexWriter(index_config)
+                add_from_cache(writer, live_chunks())
+            else:
+                add_from_cache(writer, new_chunks)
+            stats.add("index", total_chunks if removed_ids else len(new_chunks), time.perf_counter() - started)
+        elif removed_ids:
+            writer.finish().remove_ids(np.array(removed_ids, dtype="int64"))
+        index = writer.finish()
 
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension) # L2-норма (евклидово расстояние)
-    index.add(embeddings)
+        print(f"FAISS index has {index.ntotal} vectors.")
+        print(f"Embeddings: {kept_chunks + reused_chunks} reused, {computed_chunks} recomputed.")
 
-    print(f"FAISS index created with {index.ntotal} vectors.")
+        faiss_index_path = os.path.join(snapshot_dir, FAISS_INDEX_FILE)
+        print(f"Saving FAISS index to {faiss_index_path}")
+        faiss.write_index(index, faiss_index_path)
+        save_config(index_config, snapshot_dir)
 
-    print(f"Saving FAISS index to {FAISS_INDEX_PATH}")
-    faiss.write_index(index, FAISS_INDEX_PATH)
+        manifest["files"] = new_files
+        with open(os.path.join(snapshot_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        publish_snapshot(store_dir, version)
+        published = True
+    finally:
+        if previous_chunks is not None:
+            previous_chunks.close()
+        if built_chunks is not None:
+            built_chunks.close()
+        if not published:
+            chunk_writer.abort()
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            embedding_cache.close()
+    print(f"Snapshot {version} is now active.")
+    removed_snapshots = prune_snapshots(store_dir, keep)
+    if removed_snapshots:
+        print(f"Removed old snapshots: {', '.join(removed_snapshots)}")
+    if previous_version is None:
+        # Файлы сборок до появления снимков больше не читаются
+        for legacy_file in (FAISS_INDEX_FILE, CHUNK_STORE_FILE, METADATA_FILE, LEGACY_BM25_FILE,
+                            MANIFEST_FILE, INDEX_CONFIG_FILE):
+            if os.path.exists(os.path.join(store_dir, legacy_file)):
+                os.remove(os.path.join(store_dir, legacy_file))
 
-    print(f"Saving metadata to {METADATA_PATH}")
-    with open(METADATA_PATH, 'wb') as f:
-        pickle.dump({"texts": all_chunks_text, "metadata": metadata}, f)
+    embedding_cache.prune(chunk_hash for _, chunk_hash in live_chunks())
+    embedding_cache.close()
 
+    total_seconds = time.perf_counter() - build_started
+    print(f"Stage throughput (total {total_seconds:.2f}s):")
+    stats.report()
     print("Vector store built successfully!")
+    return {
+        "documents": len(documents),
+        "chunks": total_chunks,
+        "reused_embeddings": kept_chunks + reused_chunks,
+        "computed_embeddings": computed_chunks,
+        "seconds": total_seconds,
+        "snapshot": version,
+        "stages": {stage: {"count": count, "seconds": seconds} for stage, (count, seconds) in stats.stats.items()},
+    }
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,89 @@
+"""Локальный фейковый OpenAI-совместимый сервер для проверки LLM-слоя без обращения к OpenAI.
+
+Запуск из корня проекта:
+    python scripts/fake_openai_server.py --port 8081 --ttft 0.3 --token-delay 0.02
+И затем бот/скрипты с переменными окружения:
+    OPENAI_BASE_URL=http://127.0.0.1:8081/v1 OPENAI_API_KEY=fake
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from aiohttp import web
+
+DEFAULT_ANSWER = (
+    "Это тестовый ответ фейкового сервера. При найме горничной проверьте рекомендации, "
+    "проведите пробную уборку и объясните стандарты качества. "
+)
+
+
+def create_app(ttft=0.2, token_delay=0.02, answer=DEFAULT_ANSWER, repeat=3):
+    """Создает aiohttp-приложение, имитирующее /v1/chat/completions (включая stream=True)."""
+    tokens = [word + " " for word in (answer * repeat).split()]
+
+    async def chat_completions(request):
+        body = await request.json()
+        model = body.get("model", "fake-model")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        request.app["stats"]["requests"] += 1
+
+        await asyncio.sleep(ttft)
+        if not body.get("stream"):
+            await asyncio.sleep(token_delay * len(tokens))
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def event(delta, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        await response.write(event({"role": "assistant", "content": ""}))
+        for token in tokens:
+            await response.write(event({"content": token}))
+            if token_delay:
+                await asyncio.sleep(token_delay)
+        await response.write(event({}, finish_reason="stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app["stats"] = {"requests": 0}
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible streaming server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--ttft", type=float, default=0.2, help="Задержка до первого токена, сек")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Задержка между токенами, сек")
+    args = parser.parse_args()
+    web.run_app(create_app(ttft=args.ttft, token_delay=args.token_delay), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""Нагрузочный тест слоя бота: диспетчер aiogram, FSM, отправка сообщений.
+
+Синтетические (или записанные) обновления Telegram подаются прямо в
+Dispatcher.feed_update с настоящим роутером из bot.handlers. Исходящие вызовы
+Bot API уходят на локальный фейковый сервер с задержкой и flood-лимитами
+(429 с retry_after), а RAG заменен заглушкой с настраиваемым временем поиска
+и генерации. Отчет: обновлений в секунду, перцентили времени по хендлерам,
+доля ошибок и ответы фейкового API по методам.
+
+Запуск из корня проекта:
+    python scripts/load_test_bot.py run --updates 2000 --concurrency 50
+    python scripts/load_test_bot.py run --replay updates.jsonl --concurrency 200 --output load.json
+    python scripts/load_test_bot.py fake-api --port 8082   # отдельно, чтобы не делить с ботом event loop
+    python scripts/load_test_bot.py run --api-url http://127.0.0.1:8082
+Файл для --replay — по JSON-объекту Update (как их присылает Telegram) на строку.
+"""
+import os
+import sys
+import argparse
+import asyncio
+import json
+import math
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+# Ключ не используется (RAG — заглушка), но без него не создается LLMService при импорте хендлеров
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from benchmark import summarize
+
+BOT_TOKEN = "123456789:LOADTEST-fake-token"
+BOT_USER = {"id": 123456789, "is_bot": True, "first_name": "RentMentorBot", "username": "rent_mentor_test_bot"}
+QUESTIONS = [
+    "Как нанять хорошую горничную?", "Сколько платить горничной за уборку?", "Как поднять загрузку зимой?",
+    "Что писать в объявлении на Авито?", "Как работать с отзывами гостей?", "Как считать окупаемость квартиры?",
+    "Какой депозит брать с гостей?", "Как организовать заселение без встречи?",
+]
+TEMPLATE_QUERIES = ["вакансия менеджер", "чек-лист горничная", "регламент уборки", "договор аренды"]
+TOPIC_CALLBACKS = ["topic_найм", "topic_продажи", "topic_финансы", "topic_управление", "topic_горничные"]
+# Сценарии синтетического пользователя и их веса
+SCENARIOS = {"question": 6, "topic_question": 2, "start": 1, "template": 1}
+
+
+# --- Фейковый Bot API ---
+
+class _RateLimiter:
+    """Token bucket: rate запросов в секунду с запасом burst."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        """0, если запрос можно выполнить, иначе через сколько секунд появится место."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def create_fake_api(latency=0.05, chat_rate=1.0, chat_burst=10, global_rate=30.0, flood_probability=0.0, seed=0):
+    """aiohttp-приложение, отвечающее на /bot<token>/<method> как Bot API.
+
+    Задержка каждого ответа — latency * U(0.5, 1.5). Отправка и редактирование
+    сообщений ограничены chat_rate в секунду на чат (с запасом chat_burst) и
+    global_rate на весь бот; сверх лимита — 429 с retry_after, как у Telegram.
+    flood_probability — доля случайных 429 сверх этого.
+    """
+    rng = random.Random(seed)
+    chat_limits = {}
+    global_limit = _RateLimiter(global_rate, global_rate)
+    message_ids = defaultdict(int)
+    stats = {"requests": defaultdict(int), "flood": defaultdict(int)}
+    limited_methods = ("sendMessage", "editMessageText", "sendDocument", "sendMediaGroup")
+
+    def message(chat_id, **fields):
+        message_ids[chat_id] += 1
+        return {"message_id": message_ids[chat_id], "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, **fields}
+
+    def document(n):
+        file_id = f"doc-{n}-{rng.getrandbits(32):08x}"
+        return {"file_id": file_id, "file_unique_id": file_id, "file_name": f"template_{n}.docx"}
+
+    async def handle(request):
+        method = request.match_info["method"]
+        params = await request.post()
+        stats["requests"][method] += 1
+        if latency:
+            await asyncio.sleep(latency * rng.uniform(0.5, 1.5))
+
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if method in limited_methods:
+            limiter = chat_limits.setdefault(chat_id, _RateLimiter(chat_rate, chat_burst))
+            retry_after = limiter.acquire() or global_limit.acquire()
+            if not retry_after and flood_probability and rng.random() < flood_probability:
+                retry_after = 1.0
+            if retry_after:
+                stats["flood"][method] += 1
+                retry_after = max(1, math.ceil(retry_after))
+                return web.json_response({
+                    "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                })
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "sendMessage":
+            result = message(chat_id, text=params.get("text", ""))
+        elif method == "editMessageText":
+            result = message(chat_id, text=params.get("text", ""))
+            result["message_id"] = int(params.get("message_id", 0) or 0)
+        elif method == "sendDocument":
+            result = message(chat_id, document=document(message_ids[chat_id]))
+        elif method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            group_id = str(rng.getrandbits(48))
+            result = [message(chat_id, document=document(i), media_group_id=group_id) for i in range(len(media))]
+        else:
+            result = True # answerCallbackQuery, deleteMessage, sendChatAction и т. п.
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["stats"] = stats
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+async def start_fake_api(args):
+    app = create_fake_api(latency=args.api_latency, chat_rate=args.chat_rate, chat_burst=args.chat_burst,
+                          global_rate=args.global_rate, flood_probability=args.flood_probability, seed=args.seed)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, app["stats"], f"http://127.0.0.1:{port}"
+
+
+# --- Заглушка RAG ---
+
+def create_stub_rag(retrieval_delay, ttft, token_delay, answer_tokens):
+    """RAGProcessor с настоящими кэшем, схлопыванием одинаковых вопросов и стримингом,
+    но без индекса и LLM: поиск — time.sleep в потоке executor'а (как эмбеддинг и FAISS),
+    генерация — токены с задержкой."""
+    from core.answer_cache import AnswerCache
+    from core.rag_processor import RAGProcessor
+
+    class StubVectorStore:
+        index_version = "load-test"
+
+    class StubLLM:
+        model_name = "gpt-4o-mini"
+
+        async def aclose(self):
+            pass
+
+    class StubRAGProcessor(RAGProcessor):
+        async def _stream_answer(self, user_question, k_results, topic):
+            await asyncio.get_running_loop().run_in_executor(None, time.sleep, retrieval_delay)
+            await asyncio.sleep(ttft)
+            for i in range(answer_tokens):
+                yield f"слово{i} "
+                if token_delay:
+                    await asyncio.sleep(token_delay)
+
+    return StubRAGProcessor(vector_store=StubVectorStore(), llm_service=StubLLM(),
+                            answer_cache=AnswerCache(max_size=0, persist_path="", shared_url=""))
+
+
+def create_template_dir(path, count=20):
+    rng = random.Random(0)
+    words = " ".join(TEMPLATE_QUERIES).split()
+    for i in range(count):
+        topic_dir = os.path.join(path, rng.choice(["Найм", "Горничные", "Продажи"]))
+        os.makedirs(topic_dir, exist_ok=True)
+        with open(os.path.join(topic_dir, f"{rng.choice(words)}_{rng.choice(words)}_{i}.txt"), 'w', encoding='utf-8') as f:
+            f.write("Шаблон для нагрузочного теста\n" * 20)
+
+
+# --- Обновления ---
+
+class UpdateFactory:
+    def __init__(self, seed, hot_questions):
+        self.rng = random.Random(seed)
+        self.update_id = 0
+        self.message_ids = defaultdict(int)
+        self.hot_questions = hot_questions
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+    def _message(self, user_id, text):
+        self.update_id += 1
+        self.message_ids[user_id] += 1
+        message = {"message_id": self.message_ids[user_id], "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self.update_id, "message": message}
+
+    def _callback(self, user_id, data):
+        self.update_id += 1
+        bot_message = {"message_id": self.message_ids[user_id], "date": int(time.time()),
+                       "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "Чем могу помочь?"}
+        return {"update_id": self.update_id, "callback_query": {
+            "id": f"cq-{self.update_id}", "from": self._user(user_id), "chat_instance": str(user_id),
+            "message": bot_message, "data": data,
+        }}
+
+    def question(self):
+        # Часть вопросов — одинаковые "горячие" (как после урока), остальные уникальные
+        if self.rng.random() < self.hot_questions:
+            return self.rng.choice(QUESTIONS)
+        return f"{self.rng.choice(QUESTIONS)} (вариант {self.rng.getrandbits(24)})"
+
+    def scenario(self, user_id, name):
+        """Последовательность (вид, update) одного пользовательского действия."""
+        if name == "start":
+            return [("start", self._message(user_id, "/start"))]
+        if name == "topic_question":
+            return [("topic", self._callback(user_id, self.rng.choice(TOPIC_CALLBACKS))),
+                    ("question", self._message(user_id, self.question()))]
+        if name == "template":
+            return [("template_start", self._callback(user_id, "request_template_start")),
+                    ("template_keywords", self._message(user_id, self.rng.choice(TEMPLATE_QUERIES)))]
+        return [("question", self._message(user_id, self.question()))]
+
+
+def synthetic_scripts(args):
+    """Списки обновлений по пользователям: у одного пользователя они идут строго по очереди."""
+    factory = UpdateFactory(args.seed, args.hot_questions)
+    names, weights = zip(*SCENARIOS.items())
+    scripts = defaultdict(list)
+    produced = 0
+    while produced < args.updates:
+        user_id = 1000 + factory.rng.randrange(args.users)
+        steps = factory.scenario(user_id, factory.rng.choices(names, weights)[0])
+        scripts[user_id].extend(steps)
+        produced += len(steps)
+    return list(scripts.values())
+
+
+def update_kind(data):
+    if "callback_query" in data:
+        return "callback:" + (data["callback_query"].get("data") or "").split("_")[0]
+    text = (data.get("message") or {}).get("text") or ""
+    return "command" if text.startswith("/") else "message"
+
+
+def replay_scripts(path):
+    scripts = defaultdict(list)
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                data = json.loads(line)
+                event = data.get("message") or data.get("callback_query") or {}
+                scripts[(event.get("from") or {}).get("id", 0)].append((update_kind(data), data))
+    return list(scripts.values())
+
+
+# --- Прогон ---
+
+def handler_timer(durations, errors):
+    """Inner-middleware: время и ошибки по хендлерам, как у MetricsMiddleware, но с сырыми значениями."""
+    from aiogram import BaseMiddleware
+
+    class HandlerTimer(BaseMiddleware):
+        async def __call__(self, handler, event, data):
+            name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            except Exception:
+                errors[name] += 1
+                raise
+            finally:
+                durations[name].append(time.perf_counter() - started)
+
+    return HandlerTimer()
+
+
+async def run(args):
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+
+    import bot.handlers as handlers
+    import bot.template_delivery as template_delivery
+    from bot.file_id_cache import FileIdCache
+    from bot.fsm_storage import create_fsm_storage
+    from bot.template_catalog import TemplateCatalog
+
+    work_dir = tempfile.mkdtemp(prefix="load_test_")
+    if args.rag == "stub":
+        handlers.rag_processor = create_stub_rag(args.retrieval_delay, args.ttft, args.token_delay, args.answer_tokens)
+    else:
+        await handlers.rag_processor.start() # Настоящий индекс; LLM — через OPENAI_BASE_URL
+    templates_dir = os.path.join(work_dir, "templates")
+    create_template_dir(templates_dir)
+    handlers.template_catalog = TemplateCatalog(templates_dir)
+    handlers.template_catalog.refresh(force=True)
+    template_delivery.file_id_cache = FileIdCache(path=os.path.join(work_dir, "file_ids.json"), shared_url="")
+
+    api_runner, api_stats = None, None
+    api_url = args.api_url
+    if not api_url:
+        api_runner, api_stats, api_url = await start_fake_api(args)
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url), limit=args.connections)
+    bot = Bot(token=BOT_TOKEN, session=session)
+
+    durations, errors = defaultdict(list), defaultdict(int)
+    dp = Dispatcher(storage=create_fsm_storage(args.fsm_storage))
+    dp.include_router(handlers.router)
+    handlers.router.message.middleware(handler_timer(durations, errors))
+    handlers.router.callback_query.middleware(handler_timer(durations, errors))
+
+    scripts = replay_scripts(args.replay) if args.replay else synthetic_scripts(args)
+    total = sum(len(script) for script in scripts)
+    queue = asyncio.Queue()
+    for script in scripts:
+        queue.put_nowait(script)
+    kind_durations, kind_errors = defaultdict(list), defaultdict(int)
+    failures = defaultdict(int)
+
+    async def worker():
+        # Один виртуальный пользователь за раз: его обновления идут по очереди, как в реальном чате
+        while not queue.empty():
+            script = queue.get_nowait()
+            for kind, data in script:
+                update = Update.model_validate(data, context={"bot": bot})
+                started = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    kind_errors[kind] += 1
+                    failures[f"{type(e).__name__}: {str(e)[:80]}"] += 1
+                kind_durations[kind].append(time.perf_counter() - started)
+                if args.think_time:
+                    await asyncio.sleep(random.expovariate(1 / args.think_time))
+
+    if args.rag == "real":
+        await handlers.rag_processor.wait_ready()
+    print(f"Feeding {total} updates from {len(scripts)} users with concurrency {args.concurrency} (Bot API at {api_url})...")
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(args.concurrency, len(scripts)))))
+    elapsed = time.perf_counter() - started
+
+    await dp.storage.close()
+    await bot.session.close()
+    if api_runner is not None:
+        await api_runner.cleanup()
+
+    def describe(latencies, error_count):
+        summary = summarize(latencies) if latencies else {"count": 0}
+        if latencies:
+            summary["max"] = max(latencies)
+        summary["errors"] = error_count
+        summary["error_rate"] = error_count / len(latencies) if latencies else 0.0
+        return summary
+
+    report = {
+        "updates": total,
+        "users": len(scripts),
+        "concurrency": args.concurrency,
+        "seconds": elapsed,
+        "updates_per_second": total / elapsed if elapsed else 0.0,
+        "handlers": {name: describe(values, errors[name]) for name, values in sorted(durations.items())},
+        "update_kinds": {kind: describe(values, kind_errors[kind]) for kind, values in sorted(kind_durations.items())},
+        "failures": dict(failures),
+        "coalesced_questions": handlers.rag_processor.answer_flights.coalesced,
+    }
+    if api_stats is not None:
+        report["bot_api"] = {"requests": dict(api_stats["requests"]), "flood_429": dict(api_stats["flood"])}
+    return report
+
+
+def print_report(report):
+    print(f"\n{report['updates']} updates in {report['seconds']:.2f}s: {report['updates_per_second']:.1f} updates/s "
+          f"({report['users']} users, concurrency {report['concurrency']})")
+    for title, section in (("handler", report["handlers"]), ("update kind", report["update_kinds"])):
+        print(f"\n{title:<28} {'count':>7} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9} {'max, ms':>9} {'errors':>8}")
+        for name, stats in section.items():
+            if not stats["count"]:
+                continue
+            print(f"{name:<28} {stats['count']:>7} {stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} "
+                  f"{stats['p99'] * 1000:>9.1f} {stats['max'] * 1000:>9.1f} {stats['error_rate']:>7.1%}")
+    print(f"\nQuestions answered by coalescing: {report['coalesced_questions']}")
+    if "bot_api" in report:
+        print("Bot API requests: " + ", ".join(f"{method}={count}" for method, count in report["bot_api"]["requests"].items()))
+        flood = report["bot_api"]["flood_429"]
+        print("Bot API 429: " + (", ".join(f"{method}={count}" for method, count in flood.items()) or "none"))
+    for failure, count in report["failures"].items():
+        print(f"  {count} x {failure}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the aiogram layer with a fake Bot API")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_api_arguments(subparser):
+        subparser.add_argument("--port", type=int, default=0, help="Порт фейкового Bot API (0 — любой свободный)")
+        subparser.add_argument("--api-latency", type=float, default=0.05, help="Средняя задержка ответа Bot API, сек")
+        subparser.add_argument("--chat-rate", type=float, default=1.0, help="Сообщений в секунду на чат до 429 (0 — без лимита)")
+        subparser.add_argument("--chat-burst", type=int, default=10, help="Запас сообщений на чат сверх chat-rate")
+        subparser.add_argument("--global-rate", type=float, default=30.0, help="Сообщений в секунду на бота до 429 (0 — без лимита)")
+        subparser.add_argument("--flood-probability", type=float, default=0.0, help="Доля случайных 429")
+        subparser.add_argument("--seed", type=int, default=0)
+
+    run_parser = subparsers.add_parser("run", help="Прогнать обновления через диспетчер")
+    add_api_arguments(run_parser)
+    run_parser.add_argument("--api-url", help="Уже запущенный фейковый Bot API (fake-api); по умолчанию — в этом процессе")
+    run_parser.add_argument("--replay", help="JSONL с записанными обновлениями вместо синтетических")
+    run_parser.add_argument("--updates", type=int, default=1000, help="Сколько синтетических обновлений")
+    run_parser.add_argument("--users", type=int, default=200, help="Сколько разных синтетических пользователей")
+    run_parser.add_argument("--concurrency", type=int, default=50, help="Сколько пользователей шлют обновления одновременно")
+    run_parser.add_argument("--think-time", type=float, default=0.0, help="Средняя пауза пользователя между обновлениями, сек")
+    run_parser.add_argument("--hot-questions", type=float, default=0.3, help="Доля одинаковых популярных вопросов")
+    run_parser.add_argument("--rag", choices=("stub", "real"), default="stub",
+                            help="stub — заглушка; real — настоящий индекс, LLM через OPENAI_BASE_URL")
+    run_parser.add_argument("--retrieval-delay", type=float, default=0.02, help="Заглушка: эмбеддинг и поиск в executor'е, сек")
+    run_parser.add_argument("--ttft", type=float, default=0.3, help="Заглушка: задержка до первого токена, сек")
+    run_parser.add_argument("--token-delay", type=float, default=0.01, help="Заглушка: задержка между токенами, сек")
+    run_parser.add_argument("--answer-tokens", type=int, default=60, help="Заглушка: длина ответа в токенах")
+    run_parser.add_argument("--fsm-storage", default="", help="URL FSM-хранилища (sqlite:///path, redis://...); пусто — память")
+    run_parser.add_argument("--connections", type=int, default=100, help="Лимит соединений сессии бота")
+    run_parser.add_argument("--output", help="Сохранить отчет в JSON-файл")
+
+    api_parser = subparsers.add_parser("fake-api", help="Только фейковый Bot API (для прогона в отдельном процессе)")
+    add_api_arguments(api_parser)
+    args = parser.parse_args()
+
+    if args.command == "fake-api":
+        app = create_fake_api(latency=args.api_latency, chat_rate=args.chat_rate, chat_burst=args.chat_burst,
+                              global_rate=args.global_rate, flood_probability=args.flood_probability, seed=args.seed)
+        web.run_app(app, host="127.0.0.1", port=args.port or 8082)
+        return
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        print(f"Report saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
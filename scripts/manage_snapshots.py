@@ -0,0 +1,87 @@
+"""Снимки векторного хранилища: список, откат и удаление старых.
+
+Каждый запуск build_vector_store.py публикует новый снимок и делает его активным.
+Запущенный бот проверяет активный снимок раз в SNAPSHOT_POLL_INTERVAL секунд
+и переключается на него без перезапуска, поэтому откат — это просто смена CURRENT:
+    python scripts/manage_snapshots.py list
+    python scripts/manage_snapshots.py rollback            # на предыдущий снимок
+    python scripts/manage_snapshots.py activate 20250101-120000
+    python scripts/manage_snapshots.py prune --keep 2
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from core.chunk_store import CHUNK_STORE_FILE, ChunkStore
+from core.index_config import load_config
+from core.snapshots import SNAPSHOT_KEEP, current_version, list_snapshots, prune_snapshots, set_current, snapshot_path
+
+VECTOR_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "vector_store_cache")
+
+
+def describe(store_dir, version):
+    path = snapshot_path(store_dir, version)
+    size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    config = load_config(path)
+    chunks = ""
+    if os.path.exists(os.path.join(path, CHUNK_STORE_FILE)):
+        store = ChunkStore(os.path.join(path, CHUNK_STORE_FILE))
+        chunks = f"{len(store)} chunks, "
+        store.close()
+    return f"{chunks}{config['index_type']}/{config['storage']}, {size / 1024 / 1024:.1f} MB"
+
+
+def list_command(args):
+    active = current_version(args.store_dir)
+    snapshots = list_snapshots(args.store_dir)
+    if not snapshots:
+        print("No snapshots yet. Run build_vector_store.py first.")
+        return
+    for version in snapshots:
+        marker = "*" if version == active else " "
+        print(f"{marker} {version}  {describe(args.store_dir, version)}")
+
+
+def activate(store_dir, version):
+    set_current(store_dir, version)
+    print(f"Snapshot {version} is now active. Running bots switch to it within SNAPSHOT_POLL_INTERVAL.")
+
+
+def rollback_command(args):
+    active = current_version(args.store_dir)
+    older = [version for version in list_snapshots(args.store_dir) if active is None or version < active]
+    if not older:
+        sys.exit("No snapshot older than the active one to roll back to.")
+    activate(args.store_dir, older[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage vector store snapshots")
+    parser.add_argument("--store-dir", default=VECTOR_STORE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("list", help="Показать снимки (* — активный)")
+    subparsers.add_parser("rollback", help="Сделать активным предыдущий снимок")
+    activate_parser = subparsers.add_parser("activate", help="Сделать активным указанный снимок")
+    activate_parser.add_argument("version")
+    prune_parser = subparsers.add_parser("prune", help="Удалить старые снимки")
+    prune_parser.add_argument("--keep", type=int, default=SNAPSHOT_KEEP, help="Сколько последних снимков оставить")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        list_command(args)
+    elif args.command == "rollback":
+        rollback_command(args)
+    elif args.command == "activate":
+        try:
+            activate(args.store_dir, args.version)
+        except FileNotFoundError as e:
+            sys.exit(str(e))
+    else:
+        removed = prune_snapshots(args.store_dir, args.keep)
+        print(f"Removed: {', '.join(removed)}" if removed else "Nothing to remove.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Подбор типа и параметров FAISS-индекса по реальному корпусу.
+
+Для каждой конфигурации строит индекс по эмбеддингам из кэша сборщика,
+измеряет recall@k относительно точного поиска (flat_ip) и число запросов
+в секунду. Запускать из папки scripts после build_vector_store.py:
+    python tune_index.py --k 5 --nlist 256,1024 --nprobe 1,4,16,64 --m 16,32 --ef-search 16,64,128
+    python tune_index.py --storage float32,float16,int8
+"""
+import os
+import sys
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from core.index_config import VECTOR_STORAGES, make_config, create_index, needs_training, apply_search_params, normalize
+from core.snapshots import resolve_store_dir
+
+from build_vector_store import VECTOR_STORE_DIR, EMBEDDING_CACHE_PATH, EmbeddingCache, open_chunks
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def storage_list(value):
+    storages = [v for v in value.split(",") if v]
+    unknown = set(storages) - set(VECTOR_STORAGES)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown storage {', '.join(sorted(unknown))}, expected {VECTOR_STORAGES}")
+    return storages
+
+
+def load_corpus_vectors(batch_size=256):
+    chunks = open_chunks(resolve_store_dir(VECTOR_STORE_DIR)[0])
+    ids, hashes = [], []
+    for chunk_id, _, meta in chunks.iter_chunks():
+        ids.append(chunk_id)
+        hashes.append(meta["chunk_hash"])
+    model_name = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+    cache = EmbeddingCache(EMBEDDING_CACHE_PATH, model_name)
+    embeddings = cache.get_many(set(hashes))
+    # Кэш могли удалить или собрать другой моделью — недостающие эмбеддинги считаем заново
+    missing_ids = [chunk_id for chunk_id, chunk_hash in zip(ids, hashes) if chunk_hash not in embeddings]
+    if missing_ids:
+        from sentence_transformers import SentenceTransformer
+        print(f"{len(missing_ids)} chunks are missing from the embedding cache, encoding them with {model_name}...")
+        model = SentenceTransformer(model_name)
+        for start in range(0, len(missing_ids), batch_size):
+            texts = chunks.get_many(missing_ids[start:start + batch_size])
+            missing = {meta["chunk_hash"]: text for text, meta in texts.values()}
+            computed = dict(zip(missing, model.encode(list(missing.values()), batch_size=64)))
+            cache.put_many(computed)
+            embeddings.update(computed)
+    cache.close()
+    chunks.close()
+    ids = np.array(ids, dtype="int64")
+    vectors = np.vstack([embeddings[h] for h in hashes])
+    return ids, normalize(vectors)
+
+
+def load_queries(args, corpus):
+    if args.queries:
+        from sentence_transformers import SentenceTransformer
+        with open(args.queries, 'r', encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+        model = SentenceTransformer(os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2"))
+        return normalize(model.encode(questions))
+    # Без файла с вопросами берем случайные чанки корпуса с небольшим шумом
+    rng = np.random.default_rng(args.seed)
+    sample = corpus[rng.choice(len(corpus), size=min(args.num_queries, len(corpus)), replace=False)]
+    return normalize(sample + rng.normal(scale=args.noise, size=sample.shape).astype("float32"))
+
+
+def candidate_configs(args):
+    for storage in args.storage:
+        yield make_config("flat_ip", storage=storage)
+    for nlist in args.nlist:
+        for nprobe in args.nprobe:
+            if nprobe <= nlist:
+                for storage in args.storage:
+                    yield make_config("ivf_flat", nlist=nlist, nprobe=nprobe, storage=storage)
+                yield make_config("ivf_pq", nlist=nlist, nprobe=nprobe, pq_m=args.pq_m)
+    for m in args.m:
+        for ef_search in args.ef_search:
+            for storage in args.storage:
+                yield make_config("hnsw", m=m, ef_search=ef_search, storage=storage)
+
+
+def evaluate(config, ids, corpus, queries, ground_truth, k):
+    started = time.perf_counter()
+    index = create_index(config, corpus.shape[1], corpus if needs_training(config) else None)
+    index.add_with_ids(corpus, ids)
+    build_seconds = time.perf_counter() - started
+    apply_search_params(index, config)
+
+    # По одному запросу, как в боте; батчевый поиск был бы заметно быстрее
+    started = time.perf_counter()
+    found = np.vstack([index.search(queries[i:i + 1], k)[1] for i in range(len(queries))])
+    search_seconds = time.perf_counter() - started
+
+    hits = sum(len(set(found[i]) & set(ground_truth[i])) for i in range(len(queries)))
+    return {
+        "config": config,
+        "recall": hits / (len(queries) * k),
+        "qps": len(queries) / search_seconds,
+        "build_seconds": build_seconds,
+    }
+
+
+def describe(config):
+    index_type = config["index_type"]
+    # PQ сжимает векторы сам, хранение на него не влияет
+    storage = "" if config["storage"] == "float32" or index_type == "ivf_pq" else f" {config['storage']}"
+    if index_type.startswith("ivf"):
+        return f"{index_type} nlist={config['nlist']} nprobe={config['nprobe']}{storage}"
+    if index_type == "hnsw":
+        return f"hnsw M={config['m']} efSearch={config['ef_search']}{storage}"
+    return index_type + storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure recall@k and QPS of FAISS index settings")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", help="Файл с вопросами (по одному на строку); по умолчанию — зашумленные чанки корпуса")
+    parser.add_argument("--num-queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--nlist", type=int_list, default=[256, 1024])
+    parser.add_argument("--nprobe", type=int_list, default=[1, 4, 16, 64])
+    parser.add_argument("--pq-m", type=int, default=16)
+    parser.add_argument("--m", type=int_list, default=[16, 32])
+    parser.add_argument("--ef-search", type=int_list, default=[16, 32, 64, 128])
+    parser.add_argument("--storage", type=storage_list, default=["float32"],
+                        help="Хранение векторов через запятую, например float32,float16,int8")
+    parser.add_argument("--threads", type=int, help="Число потоков FAISS (по умолчанию все ядра)")
+    parser.add_argument("--json", help="Сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+
+    ids, corpus = load_corpus_vectors()
+    queries = load_queries(args, corpus)
+    print(f"Corpus: {len(corpus)} vectors, dim={corpus.shape[1]}; queries: {len(queries)}")
+
+    exact = faiss.IndexIDMap(faiss.IndexFlatIP(corpus.shape[1]))
+    exact.add_with_ids(corpus, ids)
+    ground_truth = exact.search(queries, args.k)[1]
+
+    results = []
+    print(f"{'index':<40} {'recall@' + str(args.k):>10} {'qps':>10} {'build, s':>10}")
+    for config in candidate_configs(args):
+        result = evaluate(config, ids, corpus, queries, ground_truth, args.k)
+        results.append(result)
+        print(f"{describe(config):<40} {result['recall']:>10.3f} {result['qps']:>10.0f} {result['build_seconds']:>10.2f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+        print(f"Results saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
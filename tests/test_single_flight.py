@@ -0,0 +1,57 @@
+import asyncio
+import unittest
+
+from core.single_flight import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_max_waiters_enforced_when_await_is_delayed(self):
+        # Как в handle_text_question: join, затем отправка placeholder, и только потом await
+        flights = SingleFlight("test", max_waiters=2, timeout=5)
+        release = asyncio.Event()
+        joined = []
+
+        async def leader():
+            with flights.lead("q") as flight:
+                await release.wait()
+                flight.resolve("answer")
+
+        async def follower():
+            waiter = flights.join("q")
+            joined.append(waiter is not None)
+            if waiter is None:
+                return None
+            try:
+                await asyncio.sleep(0.01) # Отправка placeholder
+                return await waiter
+            finally:
+                waiter.close()
+
+        leading = asyncio.create_task(leader())
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(follower()) for _ in range(50)]
+        await asyncio.sleep(0.05)
+        release.set()
+        results = await asyncio.gather(*followers)
+        await leading
+
+        self.assertEqual(joined.count(True), 2)
+        self.assertEqual(results.count("answer"), 2)
+        self.assertEqual(flights.coalesced, 2)
+
+    async def test_closed_waiter_frees_slot(self):
+        flights = SingleFlight("test", max_waiters=1, timeout=5)
+        with flights.lead("q") as flight:
+            waiter = flights.join("q")
+            self.assertIsNotNone(waiter)
+            self.assertIsNone(flights.join("q"))
+            waiter.close()
+            waiter = flights.join("q")
+            self.assertIsNotNone(waiter)
+            flight.resolve("answer")
+        self.assertEqual(await waiter, "answer")
+        self.assertEqual(flights.coalesced, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()